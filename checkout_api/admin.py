@@ -1,3 +1,5 @@
 from django.contrib import admin
+from checkout_api.models import Product
 
 # Register your models here.
+admin.site.register(Product)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CheckoutApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'checkout_api'
+
+    def ready(self):
+        # connects the catalog invalidation signals
+        from checkout_api import catalog
@@ -0,0 +1,133 @@
+import json
+import hashlib
+import logging
+import redis
+from django.conf import settings
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from checkout_api.models import Product
+from commerceproject.redis_client import rd_instance
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_FIELDS = ('id', 'title', 'price_cents', 'stock')
+
+# seed data for an empty database, see seedproducts_service
+demo_products = [
+    {"id": 1, "title": "Abstract Horizon Painting", "price_cents": 5500, "stock": 5},
+    {"id": 2, "title": "Minimalist Ceramic Vase", "price_cents": 3200, "stock": 12},
+    {"id": 3, "title": "Handwoven Cotton Throw", "price_cents": 4500, "stock": 8},
+    {"id": 4, "title": "Solid Oak Nightstand", "price_cents": 12000, "stock": 3},
+    {"id": 5, "title": "Artisanal Scented Candle", "price_cents": 1800, "stock": 25},
+    {"id": 6, "title": "Industrial Desk Lamp", "price_cents": 6500, "stock": 10},
+    {"id": 7, "title": "Velvet Accent Pillow", "price_cents": 2500, "stock": 15},
+    {"id": 8, "title": "Matte Black Pour-Over Kit", "price_cents": 4200, "stock": 7},
+    {"id": 9, "title": "Geometric Wall Mirror", "price_cents": 8500, "stock": 4},
+    {"id": 10, "title": "Recycled Glass Carafe", "price_cents": 2800, "stock": 20}
+]
+
+def catalog_key(name):
+    # namespaced by database so the test database never shares a cache with the real one
+    return f"catalog:{connection.settings_dict['NAME']}:{name}"
+
+def build_index(products):
+    return {product['id']: product for product in products}
+
+def build_catalog(version, products):
+    return {'version': version, 'products': products, 'index': build_index(products)}
+
+# the catalog as of the last version this process has seen, swapped as a whole on change
+local_catalog = build_catalog(None, [])
+
+def load_products_from_db():
+    return list(Product.objects.values(*PRODUCT_FIELDS))
+
+def get_catalog_version():
+    return int(rd_instance.get(catalog_key('version')) or 0)
+
+def get_catalog():
+    global local_catalog
+
+    try:
+        version = get_catalog_version()
+    except redis.exceptions.RedisError:
+        logger.warning('Catalog cache is unavailable, reading products from the database.')
+        return build_catalog(None, load_products_from_db())
+
+    if local_catalog['version'] == version:
+        return local_catalog
+
+    products_key = catalog_key(f'products:{version}')
+
+    try:
+        cached_products = rd_instance.get(products_key)
+    except redis.exceptions.RedisError:
+        cached_products = None
+
+    if cached_products is not None:
+        products = json.loads(cached_products)
+    else:
+        products = load_products_from_db()
+
+        try:
+            rd_instance.set(products_key, json.dumps(products), ex=settings.CATALOG_CACHE_TTL)
+        except redis.exceptions.RedisError:
+            logger.warning('Could not write catalog version %s to the cache.', version)
+
+    local_catalog = build_catalog(version, products)
+
+    return local_catalog
+
+def bump_version():
+    # every worker compares its local version against this counter, so one INCR invalidates all of them
+    try:
+        return rd_instance.incr(catalog_key('version'))
+    except redis.exceptions.RedisError:
+        logger.exception('Could not bump the catalog version.')
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_catalog(sender, **kwargs):
+    transaction.on_commit(bump_version)
+
+def get_products():
+    return get_catalog()['products']
+
+def render_products(products):
+    body = JSONRenderer().render(products)
+    digest = hashlib.sha256(body).hexdigest()[:32]
+
+    return {
+        'body': body,
+        'etag': f'"{digest}"',
+        'gzip_body': compress_string(body),
+        'gzip_etag': f'"{digest}-gzip"'
+    }
+
+def get_rendered_products():
+    # rendered at most once per catalog version and process
+    catalog = get_catalog()
+
+    if 'rendered' not in catalog:
+        catalog['rendered'] = render_products(catalog['products'])
+
+    return catalog['rendered']
+
+# each get_catalog() costs a Redis round trip to check the version, code handling one request passes
+# the catalog it got first along instead of looking it up again per product
+
+def get_product(product_id, catalog=None):
+    return (catalog or get_catalog())['index'].get(product_id)
+
+def get_products_by_id(product_ids, catalog=None):
+    # resolves every id in a single pass over the ids, missing ones map to None
+    index = (catalog or get_catalog())['index']
+
+    return {product_id: index.get(product_id) for product_id in product_ids}
+
+def resolve_cart(cart_items, catalog=None):
+    products = get_products_by_id((cart_item['product_id'] for cart_item in cart_items), catalog)
+
+    return [(cart_item, products[cart_item['product_id']]) for cart_item in cart_items]
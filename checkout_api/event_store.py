@@ -0,0 +1,111 @@
+import logging
+import redis
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from checkout_api.models import WebhookEvent
+from commerceproject.redis_client import rd_instance
+
+logger = logging.getLogger(__name__)
+
+PROCESSING = 'processing'
+DONE = 'done'
+
+def event_key(event_id):
+    return f"stripe-event:{connection.settings_dict['NAME']}:{event_id}"
+
+def store_webhook_event(event_id, event_type, payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+
+    event, created = WebhookEvent.objects.get_or_create(event_id=event_id, defaults={'event_type': event_type, 'payload': payload})
+
+    return event
+
+def cache_processed(event_ids):
+    # the event table has the final say, Redis only answers repeats without a query
+    try:
+        pipeline = rd_instance.pipeline(transaction=False)
+
+        for event_id in event_ids:
+            pipeline.set(event_key(event_id), DONE, ex=settings.STRIPE_EVENT_DEDUPE_TTL)
+
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        logger.warning('Could not mark %s webhook events as processed in Redis.', len(event_ids))
+
+def mark_processed(event_ids):
+    WebhookEvent.objects.filter(event_id__in=event_ids).update(processed_at=timezone.now())
+    cache_processed(event_ids)
+
+@contextmanager
+def recorded_webhook_event(event_id, event_type, payload):
+    # yields False for an event that was already processed (or is being processed right now)
+    try:
+        claimed = rd_instance.set(event_key(event_id), PROCESSING, nx=True, ex=settings.STRIPE_EVENT_LOCK_TTL)
+    except redis.exceptions.RedisError:
+        logger.warning('Event de-duplication is unavailable, falling back to the event table.')
+        claimed = True
+
+    if not claimed:
+        yield False
+        return
+
+    try:
+        event = store_webhook_event(event_id, event_type, payload)
+
+        # seen before the Redis key ran out
+        if event.processed_at is not None:
+            cache_processed([event_id])
+            yield False
+            return
+
+        yield True
+    except BaseException:
+        release_webhook_events([event_id])
+        raise
+
+    mark_processed([event_id])
+
+def claim_webhook_events(events):
+    # the batched recorded_webhook_event(), takes (event id, event type, payload) tuples and
+    # returns the ids of the ones that still have to be applied
+    try:
+        pipeline = rd_instance.pipeline(transaction=False)
+
+        for event_id, _, _ in events:
+            pipeline.set(event_key(event_id), PROCESSING, nx=True, ex=settings.STRIPE_EVENT_LOCK_TTL)
+
+        claimed = [event for event, is_claimed in zip(events, pipeline.execute()) if is_claimed]
+    except redis.exceptions.RedisError:
+        logger.warning('Event de-duplication is unavailable, falling back to the event table.')
+        claimed = events
+
+    if not claimed:
+        return []
+
+    WebhookEvent.objects.bulk_create([
+        WebhookEvent(event_id=event_id, event_type=event_type, payload=payload.decode('utf-8') if isinstance(payload, bytes) else payload)
+        for event_id, event_type, payload in claimed
+    ], ignore_conflicts=True)
+
+    event_ids = [event_id for event_id, _, _ in claimed]
+    # seen before their Redis keys ran out
+    processed = set(WebhookEvent.objects.filter(event_id__in=event_ids, processed_at__isnull=False).values_list('event_id', flat=True))
+
+    if processed:
+        cache_processed(list(processed))
+
+    return [event_id for event_id in event_ids if event_id not in processed]
+
+def release_webhook_events(event_ids):
+    # lets another delivery of these events through
+    if not event_ids:
+        return
+
+    try:
+        rd_instance.delete(*[event_key(event_id) for event_id in event_ids])
+    except redis.exceptions.RedisError:
+        # their locks run out after STRIPE_EVENT_LOCK_TTL instead
+        logger.warning('Could not release %s webhook events in Redis.', len(event_ids))
@@ -0,0 +1,37 @@
+import redis
+from django.conf import settings
+from django.db import connection
+from commerceproject.redis_client import rd_instance
+
+CONSUMER_GROUP = 'webhook-consumers'
+
+def stream_key():
+    return f"stripe-events:{connection.settings_dict['NAME']}"
+
+def append_webhook_event(payload):
+    # the raw body, so the web worker never parses it
+    return rd_instance.xadd(stream_key(), {'payload': payload}, maxlen=settings.STRIPE_EVENT_STREAM_MAXLEN, approximate=True)
+
+def ensure_consumer_group():
+    try:
+        rd_instance.xgroup_create(stream_key(), CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def read_webhook_events(consumer, count):
+    ensure_consumer_group()
+
+    # events of consumers that died before acknowledging them come first
+    _, entries, *_ = rd_instance.xautoclaim(stream_key(), CONSUMER_GROUP, consumer, min_idle_time=settings.STRIPE_EVENT_CLAIM_IDLE_MS, start_id='0-0', count=count)
+
+    if len(entries) < count:
+        for _, new_entries in rd_instance.xreadgroup(CONSUMER_GROUP, consumer, {stream_key(): '>'}, count=count - len(entries)):
+            entries += new_entries
+
+    return [(entry_id, fields['payload']) for entry_id, fields in entries if fields]
+
+def ack_webhook_events(entry_ids):
+    if entry_ids:
+        rd_instance.xack(stream_key(), CONSUMER_GROUP, *entry_ids)
+        rd_instance.xdel(stream_key(), *entry_ids)
@@ -0,0 +1,96 @@
+import json
+import time
+import hashlib
+import logging
+import redis
+from django.conf import settings
+from django.db import connection
+from rest_framework import status
+from rest_framework.response import Response
+from commerceproject.redis_client import rd_instance
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+POLL_INTERVAL = 0.05
+
+def idempotency_key(scope, key):
+    return f"idempotency:{connection.settings_dict['NAME']}:{scope}:{key}"
+
+def fingerprint_request(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def replay(entry, fingerprint):
+    if entry['fingerprint'] != fingerprint:
+        return Response({'msg': 'This Idempotency-Key was already used with a different request.'}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    response = Response(entry['data'], status=entry['status'])
+    response.headers['Idempotent-Replayed'] = 'true'
+
+    return response
+
+def wait_for_entry(redis_key):
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+
+    while time.monotonic() < deadline:
+        cached_entry = rd_instance.get(redis_key)
+
+        if cached_entry is None or json.loads(cached_entry)['state'] == DONE:
+            return cached_entry
+
+        time.sleep(POLL_INTERVAL)
+
+    return rd_instance.get(redis_key)
+
+def retryable(response):
+    # the response depends on state a retry may find changed, so its key is given up instead of stored
+    response.retryable = True
+
+    return response
+
+def run_idempotent(scope, key, data, handler):
+    # handler runs at most once per key, repeats get the stored response and
+    # concurrent repeats wait for the request in flight to finish
+    if len(key) > 255:
+        return Response({'msg': 'Idempotency-Key must be 255 characters or fewer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    redis_key = idempotency_key(scope, key)
+    fingerprint = fingerprint_request(data)
+    pending_entry = json.dumps({'state': PENDING, 'fingerprint': fingerprint})
+
+    try:
+        while not rd_instance.set(redis_key, pending_entry, nx=True, ex=settings.IDEMPOTENCY_LOCK_TTL):
+            cached_entry = wait_for_entry(redis_key)
+
+            if cached_entry is None:
+                # the first request failed and gave up the key, try to take it over
+                continue
+
+            entry = json.loads(cached_entry)
+
+            if entry['state'] == DONE:
+                return replay(entry, fingerprint)
+
+            return Response({'msg': 'A request with this Idempotency-Key is still in progress.'}, status=status.HTTP_409_CONFLICT)
+    except redis.exceptions.RedisError:
+        logger.exception('Idempotency store is unavailable, handling the request without it.')
+        return handler()
+
+    try:
+        response = handler()
+    except Exception:
+        rd_instance.delete(redis_key)
+        raise
+
+    try:
+        if response.status_code >= 500 or getattr(response, 'retryable', False):
+            # server side failures are worth retrying, and so is anything the handler marked retryable
+            rd_instance.delete(redis_key)
+        else:
+            done_entry = {'state': DONE, 'fingerprint': fingerprint, 'status': response.status_code, 'data': response.data}
+            rd_instance.set(redis_key, json.dumps(done_entry), ex=settings.IDEMPOTENCY_KEY_TTL)
+    except redis.exceptions.RedisError:
+        logger.exception('Could not store the response for Idempotency-Key %s.', key)
+
+    return response
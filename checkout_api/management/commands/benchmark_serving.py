@@ -0,0 +1,104 @@
+import sys
+import time
+import socket
+import threading
+import subprocess
+import http.client
+from itertools import count
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class Command(BaseCommand):
+    help = "Compares the throughput of runserver with the gunicorn configuration, serving the same endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=16, help='Clients sending requests at once, each over one keep-alive connection')
+        parser.add_argument('--path', default='/api/checkout/demo-products/')
+
+    def handle(self, *args, **options):
+        servers = {
+            'runserver': lambda port: [sys.executable, 'manage.py', 'runserver', '--noreload', f'127.0.0.1:{port}'],
+            'gunicorn': lambda port: [sys.executable, '-m', 'gunicorn', '-c', 'python:commerceproject.gunicorn_conf', '--bind', f'127.0.0.1:{port}', 'commerceproject.wsgi'],
+        }
+        results = {}
+
+        for name, command in servers.items():
+            port = free_port()
+            process = subprocess.Popen(command(port), cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            try:
+                self.wait_until_ready(name, process, port)
+                results[name] = self.measure(port, options['path'], options['requests'], options['concurrency'])
+            finally:
+                # TERM is a graceful shutdown for both
+                process.terminate()
+                process.wait(timeout=60)
+
+            throughput, p99, errors = results[name]
+            self.stdout.write('%s: %.1f requests/s, p99 %.1f ms, %s errors' % (name, throughput, p99 * 1000, errors))
+
+        self.stdout.write(
+            self.style.SUCCESS('Successfully served "%s" requests, %.1fx faster with gunicorn' % (options['requests'], results['gunicorn'][0] / results['runserver'][0])))
+
+    def wait_until_ready(self, name, process, port):
+        deadline = time.monotonic() + 30
+
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'{name} exited with {process.returncode} before serving')
+
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+
+        raise CommandError(f'{name} did not start within 30 seconds')
+
+    def measure(self, port, path, requests, concurrency):
+        tickets = count()
+        latencies = []
+        errors = []
+
+        def client():
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+            while next(tickets) < requests:
+                started = time.perf_counter()
+
+                try:
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    response.read()
+                except (OSError, http.client.HTTPException):
+                    errors.append(None)
+                    connection.close()
+                    continue
+
+                latencies.append(time.perf_counter() - started)
+
+                if response.status >= 500:
+                    errors.append(response.status)
+
+            connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        started = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+
+        return requests / elapsed, p99, len(errors)
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from checkout_api.outbox import relay_outbox
+
+class Command(BaseCommand):
+    help = "Publishes the tasks waiting in the outbox to Celery"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--forever', action='store_true', help='Keep relaying instead of stopping once the outbox is empty')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds to wait whenever the outbox is empty')
+
+    def handle(self, *args, **options):
+        count = 0
+
+        while True:
+            relayed = relay_outbox(options['batch_size'])
+            count += relayed
+
+            if not relayed:
+                if not options['forever']:
+                    break
+
+                time.sleep(options['interval'])
+
+        self.stdout.write(
+            self.style.SUCCESS('Successfully relayed "%s" outbox messages' % count))
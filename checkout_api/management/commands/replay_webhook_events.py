@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from checkout_api.services import replay_webhook_events_service
+
+class Command(BaseCommand):
+    help = "Replays the stored Stripe webhook events received in a time range"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', required=True, help='ISO 8601 start of the range, inclusive')
+        parser.add_argument('--until', help='ISO 8601 end of the range, exclusive (defaults to now)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--include-processed', action='store_true', help='Replay events that were already processed too')
+
+    def parse_datetime(self, value):
+        parsed = parse_datetime(value)
+
+        if parsed is None:
+            raise CommandError(f'"{value}" is not a valid ISO 8601 datetime')
+
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+
+        return parsed
+
+    def handle(self, *args, **options):
+        since = self.parse_datetime(options['since'])
+        until = self.parse_datetime(options['until']) if options['until'] else timezone.now()
+        count = 0
+
+        # receipts of the orders that changed are published through the outbox
+        for event_ids, _ in replay_webhook_events_service(since, until, options['batch_size'], options['include_processed']):
+            count += len(event_ids)
+
+        self.stdout.write(
+            self.style.SUCCESS('Successfully replayed "%s" webhook events' % count))
@@ -5,8 +5,8 @@ class Command(BaseCommand):
     help = "Creates 10 new products if there aren't any in the database"
 
     def handle(self, *args, **options):
-        seedproducts_service()
+        count = seedproducts_service()
 
         self.stdout.write(
-            self.style.SUCCESS('Successfully created 10 example products'))
+            self.style.SUCCESS('Successfully created %s example products' % count))
         
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout_api', '0024_alter_orderitem_unique_order_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200)),
+                ('price_cents', models.PositiveIntegerField()),
+                ('stock', models.PositiveIntegerField()),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+# the catalog that used to be hardcoded in checkout_api/serializers.py
+demo_products = [
+    {"title": "Abstract Horizon Painting", "price_cents": 5500, "stock": 5},
+    {"title": "Minimalist Ceramic Vase", "price_cents": 3200, "stock": 12},
+    {"title": "Handwoven Cotton Throw", "price_cents": 4500, "stock": 8},
+    {"title": "Solid Oak Nightstand", "price_cents": 12000, "stock": 3},
+    {"title": "Artisanal Scented Candle", "price_cents": 1800, "stock": 25},
+    {"title": "Industrial Desk Lamp", "price_cents": 6500, "stock": 10},
+    {"title": "Velvet Accent Pillow", "price_cents": 2500, "stock": 15},
+    {"title": "Matte Black Pour-Over Kit", "price_cents": 4200, "stock": 7},
+    {"title": "Geometric Wall Mirror", "price_cents": 8500, "stock": 4},
+    {"title": "Recycled Glass Carafe", "price_cents": 2800, "stock": 20}
+]
+
+def seed_products(apps, schema_editor):
+    Product = apps.get_model('checkout_api', 'Product')
+
+    if not Product.objects.exists():
+        Product.objects.bulk_create([Product(**product) for product in demo_products])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout_api', '0025_product'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout_api', '0026_seed_products'),
+    ]
+
+    operations = [
+        # INCREMENT BY has to match ORDER_NUMBER_BLOCK_SIZE in checkout_api/models.py
+        migrations.RunSQL(
+            "CREATE SEQUENCE checkout_api_order_number_seq MINVALUE 0 START WITH 0 INCREMENT BY 50",
+            "DROP SEQUENCE checkout_api_order_number_seq",
+        ),
+    ]
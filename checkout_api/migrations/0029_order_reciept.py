@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout_api', '0028_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='reciept',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
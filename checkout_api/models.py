@@ -1,13 +1,109 @@
-from django.db import models
+from django.db import models, connection
 from time import timezone
-import random
+import os
 import string
+import threading
+
+ORDER_NUMBER_PREFIX = 'ORD-'
+ORDER_NUMBER_ALPHABET = string.ascii_uppercase + string.digits
+# older orders carry random six character numbers, so sequence based ones start at seven
+ORDER_NUMBER_LENGTH = 7
+# any multiplier coprime with 36 keeps the scrambling a bijection
+ORDER_NUMBER_MULTIPLIER = 2654435761
+ORDER_NUMBER_OFFSET = 1234567891
+ORDER_NUMBER_SEQUENCE = 'checkout_api_order_number_seq'
+# must match the INCREMENT BY of the sequence, see migration 0027
+ORDER_NUMBER_BLOCK_SIZE = 50
+
+def encode_order_number(value):
+    length = ORDER_NUMBER_LENGTH
+
+    # every length gets its own range of values, so numbers never repeat when a length runs out
+    while value >= len(ORDER_NUMBER_ALPHABET) ** length:
+        value -= len(ORDER_NUMBER_ALPHABET) ** length
+        length += 1
+
+    # scramble consecutive values so order numbers don't reveal the order volume
+    space = len(ORDER_NUMBER_ALPHABET) ** length
+    value = (value * ORDER_NUMBER_MULTIPLIER + ORDER_NUMBER_OFFSET) % space
+
+    suffix = ''
+    for _ in range(length):
+        value, index = divmod(value, len(ORDER_NUMBER_ALPHABET))
+        suffix = ORDER_NUMBER_ALPHABET[index] + suffix
+
+    return ORDER_NUMBER_PREFIX + suffix
+
+class OrderNumberAllocator:
+    # hands out values from blocks reserved with a single nextval() per ORDER_NUMBER_BLOCK_SIZE orders
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.next_value = 0
+        self.block_end = 0
+
+    def allocate(self):
+        with self.lock:
+            if self.next_value >= self.block_end:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT nextval(%s)', [ORDER_NUMBER_SEQUENCE])
+                    self.next_value = cursor.fetchone()[0]
+
+                self.block_end = self.next_value + ORDER_NUMBER_BLOCK_SIZE
+
+            value = self.next_value
+            self.next_value += 1
+
+            return value
+
+order_number_allocator = OrderNumberAllocator()
+# a forked worker must not keep handing out its parent's block
+os.register_at_fork(after_in_child=order_number_allocator.reset)
 
 def generate_order_number():
-    prefix = 'ORD-'
-    suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    return prefix + suffix
+    return encode_order_number(order_number_allocator.allocate())
+
+class Product(models.Model):
+    title = models.CharField(max_length=200)
+    price_cents = models.PositiveIntegerField()
+    stock = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"Product: {self.title}"
     
+class OrderManager(models.Manager):
+    def transition(self, payment_intent_id, status):
+        # a single conditional UPDATE, returns the pk or None when the order isn't in the expected state
+        if status not in self.model.TRANSITIONS:
+            raise ValueError(f'Orders cannot transition to status "{status}"')
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {self.model._meta.db_table} SET status = %s WHERE payment_intent_id = %s AND status = %s RETURNING id',
+                [status, payment_intent_id, self.model.TRANSITIONS[status]]
+            )
+            row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    def transition_many(self, payment_intent_ids, status):
+        # the batched transition(), returns {payment intent id: pk} for the orders that moved
+        if status not in self.model.TRANSITIONS:
+            raise ValueError(f'Orders cannot transition to status "{status}"')
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {self.model._meta.db_table} SET status = %s WHERE payment_intent_id = ANY(%s) AND status = %s RETURNING payment_intent_id, id',
+                [status, list(payment_intent_ids), self.model.TRANSITIONS[status]]
+            )
+
+            return dict(cursor.fetchall())
+
 class Order(models.Model):
     PENDING = "PN"
     PAID = "PD"
@@ -19,6 +115,11 @@ class Order(models.Model):
         SHIPPED: "Shipped",
         CANCELLED: "Cancelled",
     }
+    # the status each webhook driven status can only be reached from
+    TRANSITIONS = {
+        PAID: PENDING,
+        CANCELLED: PENDING,
+    }
 
     order_number = models.CharField(max_length=20, unique=True, editable=False, blank=True)
     status = models.CharField(
@@ -30,18 +131,17 @@ class Order(models.Model):
     contact_email = models.EmailField()
     total = models.PositiveIntegerField()
     payment_intent_id = models.CharField(max_length=50, unique=True)
+    # what the receipt email needs, written once when the order is placed
+    reciept = models.JSONField(null=True, blank=True, editable=False)
+
+    objects = OrderManager()
 
     class Meta:
         ordering = ['-date_placed']
 
     def save(self, **kwargs):
         if not self.order_number:
-            is_unique = False
-            while not is_unique:
-                new_number = generate_order_number()
-                if not Order.objects.filter(order_number=new_number).exists():
-                    self.order_number = new_number
-                    is_unique = True
+            self.order_number = generate_order_number()
         
         super().save(**kwargs)
 
@@ -60,4 +160,31 @@ class OrderItem(models.Model):
         ordering = ['-item_id']
 
     def __str__(self):
-        return f"Order item: {self.item_id}"
\ No newline at end of file
+        return f"Order item: {self.item_id}"
+
+class WebhookEvent(models.Model):
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    # the raw request body, kept for replays
+    payload = models.TextField()
+    received_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['received_at']
+
+    def __str__(self):
+        return f"Webhook event: {self.event_id}"
+
+class OutboxMessage(models.Model):
+    # a Celery task to publish, written in the same transaction as the change it follows from
+    # and deleted once the relay has handed it to the broker
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"Outbox message: {self.task}"
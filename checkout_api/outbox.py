@@ -0,0 +1,42 @@
+import logging
+from django.conf import settings
+from django.db import transaction
+from checkout_api.models import OutboxMessage
+from commerceproject.celery import app
+
+logger = logging.getLogger(__name__)
+
+# Tasks are named rather than imported, the services that write the outbox are imported by the task modules
+SENDRECIEPT_TASK = 'checkout_api.tasks.sendreciept_task'
+SENDRECIEPTS_TASK = 'checkout_api.tasks.sendreciepts_task'
+
+def add_to_outbox(task, *args):
+    # only meant to be called inside the transaction that makes the task necessary
+    return OutboxMessage.objects.create(task=task, args=list(args))
+
+def add_reciepts_to_outbox(order_pks):
+    # receipts for a batch of orders go out a chunk per task
+    size = settings.RECEIPT_CHUNK_SIZE
+
+    OutboxMessage.objects.bulk_create([
+        OutboxMessage(task=SENDRECIEPTS_TASK, args=[order_pks[index:index + size]]) for index in range(0, len(order_pks), size)
+    ])
+
+def relay_outbox(batch_size=None):
+    # publishes one batch, returns how many messages went out
+    with transaction.atomic():
+        # relays running side by side take different rows instead of waiting on each other
+        messages = list(OutboxMessage.objects.select_for_update(skip_locked=True).order_by('pk')[:batch_size or settings.OUTBOX_BATCH_SIZE])
+
+        if not messages:
+            return 0
+
+        # one broker connection for the whole batch, task_routes still apply by task name
+        with app.producer_or_acquire() as producer:
+            for message in messages:
+                app.send_task(message.task, args=message.args, producer=producer)
+
+        # a crash between the publish and this commit publishes the batch again, receipts are delivered at least once
+        OutboxMessage.objects.filter(pk__in=[message.pk for message in messages]).delete()
+
+    return len(messages)
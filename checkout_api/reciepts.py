@@ -0,0 +1,34 @@
+import threading
+from django.template import Context, engines
+
+TEMPLATE_NAMES = ('reciept.txt', 'reciept.html')
+
+templates_lock = threading.Lock()
+# compiled once per process, the template loaders only cache them with DEBUG off
+reciept_templates = None
+
+def get_reciept_templates():
+    global reciept_templates
+
+    if reciept_templates is None:
+        with templates_lock:
+            if reciept_templates is None:
+                # the engine's own Template objects, so rendering skips the request context machinery
+                reciept_templates = tuple(engines['django'].get_template(name).template for name in TEMPLATE_NAMES)
+
+    return reciept_templates
+
+def render_reciepts(reciepts):
+    # returns a (text, html) pair per receipt snapshot
+    text_template, html_template = get_reciept_templates()
+    context = Context()
+    rendered = []
+
+    for reciept in reciepts:
+        with context.push(reciept):
+            rendered.append((text_template.render(context), html_template.render(context)))
+
+    return rendered
+
+def render_reciept(reciept):
+    return render_reciepts([reciept])[0]
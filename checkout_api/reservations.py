@@ -0,0 +1,199 @@
+import time
+import uuid
+import logging
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from checkout_api.models import OrderItem, Product
+from checkout_api.catalog import get_catalog, catalog_key, bump_version
+from commerceproject.redis_client import rd_instance
+
+logger = logging.getLogger(__name__)
+
+# Stock held by unpaid orders lives in Redis: a "held" counter per product, one hash per hold
+# (product id -> quantity) and a sorted set of hold ids scored by their expiry time.
+# A cart can be reserved while held + quantity <= stock, where stock comes from the catalog. The stock
+# passed in is only trusted while the catalog version it was read at is still the current one.
+# The scripts build keys from a prefix, so they expect a single Redis instance rather than a cluster.
+
+DROP_HOLD = """
+local function drop_hold(prefix, hold_id)
+    local hold_key = prefix .. 'hold:' .. hold_id
+    local lines = redis.call('HGETALL', hold_key)
+
+    for i = 1, #lines, 2 do
+        redis.call('DECRBY', prefix .. 'held:' .. lines[i], lines[i + 1])
+    end
+
+    redis.call('DEL', hold_key)
+    redis.call('ZREM', prefix .. 'holds', hold_id)
+
+    return #lines > 0
+end
+
+local function drop_expired_holds(prefix, now, limit)
+    local expired = redis.call('ZRANGEBYSCORE', prefix .. 'holds', '-inf', now, 'LIMIT', 0, limit)
+
+    for _, hold_id in ipairs(expired) do
+        drop_hold(prefix, hold_id)
+    end
+
+    return #expired
+end
+"""
+
+# returned by reserve_script when the stock it was given is from an older catalog version
+STALE_CATALOG = 'stale'
+
+# reservations retried against a fresh catalog before giving up
+RESERVE_ATTEMPTS = 3
+
+# ARGV: prefix, now, expires at, hold id, catalog version key, catalog version, then product id, quantity, stock for every line
+reserve_script = rd_instance.register_script(DROP_HOLD + """
+local prefix = ARGV[1]
+
+if tonumber(redis.call('GET', ARGV[5]) or '0') ~= tonumber(ARGV[6]) then
+    return '""" + STALE_CATALOG + """'
+end
+
+drop_expired_holds(prefix, ARGV[2], 100)
+
+for i = 7, #ARGV, 3 do
+    local held = tonumber(redis.call('GET', prefix .. 'held:' .. ARGV[i]) or '0')
+
+    if held + tonumber(ARGV[i + 1]) > tonumber(ARGV[i + 2]) then
+        return ARGV[i]
+    end
+end
+
+local hold_key = prefix .. 'hold:' .. ARGV[4]
+
+for i = 7, #ARGV, 3 do
+    redis.call('INCRBY', prefix .. 'held:' .. ARGV[i], ARGV[i + 1])
+    redis.call('HSET', hold_key, ARGV[i], ARGV[i + 1])
+end
+
+redis.call('ZADD', prefix .. 'holds', ARGV[3], ARGV[4])
+
+return false
+""")
+
+# ARGV: prefix, hold id
+drop_script = rd_instance.register_script(DROP_HOLD + """
+return drop_hold(ARGV[1], ARGV[2]) and 1 or 0
+""")
+
+# ARGV: prefix, now, limit
+drop_expired_script = rd_instance.register_script(DROP_HOLD + """
+return drop_expired_holds(ARGV[1], ARGV[2], tonumber(ARGV[3]))
+""")
+
+# ARGV: prefix, current hold id, new hold id
+rename_script = rd_instance.register_script("""
+local prefix = ARGV[1]
+local expires_at = redis.call('ZSCORE', prefix .. 'holds', ARGV[2])
+
+if not expires_at then
+    return 0
+end
+
+redis.call('RENAME', prefix .. 'hold:' .. ARGV[2], prefix .. 'hold:' .. ARGV[3])
+redis.call('ZREM', prefix .. 'holds', ARGV[2])
+redis.call('ZADD', prefix .. 'holds', expires_at, ARGV[3])
+
+return 1
+""")
+
+def stock_prefix():
+    # namespaced by database like the catalog cache
+    return f"stock:{connection.settings_dict['NAME']}:"
+
+def reserve_stock(cart_items, catalog=None):
+    hold_id = uuid.uuid4().hex
+
+    for attempt in range(RESERVE_ATTEMPTS):
+        # the caller's catalog first, a fresh one for every retry
+        if attempt or catalog is None:
+            catalog = get_catalog()
+
+        now = time.time()
+        # a catalog read from the database while Redis was down has no version, it is checked as version 0
+        args = [stock_prefix(), now, now + settings.STOCK_HOLD_TTL, hold_id, catalog_key('version'), catalog['version'] or 0]
+
+        for cart_item in cart_items:
+            product = catalog['index'].get(cart_item['product_id'])
+
+            # deleted since the cart was validated against an older catalog
+            if product is None:
+                return {'cart_items': f"Product with id {cart_item['product_id']} doesn't exist."}
+
+            args += [product['id'], cart_item['product_quantity'], product['stock']]
+
+        short_product_id = reserve_script(args=args)
+
+        # the stock changed since this process read the catalog, the next get_catalog picks up the new one
+        if short_product_id == STALE_CATALOG:
+            continue
+
+        if short_product_id is not None:
+            return {'cart_items': f"Product with id {short_product_id} doesn't have enough stock left."}
+
+        return hold_id
+
+    logger.warning('The catalog kept changing while reserving stock.')
+
+    return {'cart_items': 'The stock changed while the order was placed, please try again.'}
+
+def rename_hold(hold_id, new_hold_id):
+    return bool(rename_script(args=[stock_prefix(), hold_id, new_hold_id]))
+
+def release_stock(hold_id):
+    return bool(drop_script(args=[stock_prefix(), hold_id]))
+
+def release_stocks(hold_ids):
+    pipeline = rd_instance.pipeline(transaction=False)
+
+    for hold_id in hold_ids:
+        drop_script(args=[stock_prefix(), hold_id], client=pipeline)
+
+    return sum(pipeline.execute())
+
+def release_expired_holds(limit=1000):
+    return drop_expired_script(args=[stock_prefix(), time.time(), limit])
+
+def commit_stock(hold_id, order_pk):
+    return commit_stocks({hold_id: order_pk})
+
+def commit_stocks(holds):
+    # holds maps hold ids to their order pks, returns the quantities summed over all of them
+    hold_ids = list(holds)
+    pipeline = rd_instance.pipeline(transaction=False)
+
+    for hold_id in hold_ids:
+        pipeline.hgetall(stock_prefix() + 'hold:' + hold_id)
+
+    quantities = {}
+    expired_order_pks = []
+
+    for hold_id, lines in zip(hold_ids, pipeline.execute()):
+        if not lines:
+            # the hold ran out before the payment came through, take the quantities from the order
+            logger.warning('Hold %s expired before its payment succeeded.', hold_id)
+            expired_order_pks.append(holds[hold_id])
+
+        for product_id, quantity in lines.items():
+            quantities[int(product_id)] = quantities.get(int(product_id), 0) + int(quantity)
+
+    for product_id, quantity in OrderItem.objects.filter(order__in=expired_order_pks).values_list('item_id', 'quantity'):
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    with transaction.atomic():
+        # one UPDATE per product, however many orders bought it
+        for product_id, quantity in quantities.items():
+            Product.objects.filter(pk=product_id).update(stock=Greatest(F('stock') - quantity, 0))
+
+        # the stock has to drop before the holds do, otherwise the units could be reserved twice
+        transaction.on_commit(lambda: (bump_version(), release_stocks(hold_ids)))
+
+    return quantities
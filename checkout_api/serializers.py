@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from checkout_api.models import Order, OrderItem
+from checkout_api.catalog import get_product
 from decimal import *
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -13,7 +14,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def validate(self, attrs):
-        product = next((item for item in demo_products if item['id'] == attrs['item_id']), None)
+        product = get_product(attrs['item_id'], self.context.get('catalog'))
 
         if product:
             if attrs['quantity'] <= product['stock']:
@@ -28,10 +29,11 @@ class OrderDataSerializer(serializers.Serializer):
 
 class CartItemSerializer(serializers.Serializer):
     product_id = serializers.IntegerField()
-    product_quantity = serializers.IntegerField()
+    # a negative quantity would release someone else's hold on the product
+    product_quantity = serializers.IntegerField(min_value=1)
 
     def validate(self, attrs):
-        product = next((item for item in demo_products if item['id'] == attrs['product_id']), None)
+        product = get_product(attrs['product_id'], self.context.get('catalog'))
 
         if product:
             if attrs['product_quantity'] <= product['stock']:
@@ -56,17 +58,4 @@ class ProductSerializer(serializers.Serializer):
 
 class StripeWebhookSerializer(serializers.Serializer):
     payload = serializers.JSONField(write_only=True)
-    stripe_signature = serializers.CharField(write_only=True)    
-
-demo_products = [
-    {"id": 1, "title": "Abstract Horizon Painting", "price_cents": 5500, "stock": 5},
-    {"id": 2, "title": "Minimalist Ceramic Vase", "price_cents": 3200, "stock": 12},
-    {"id": 3, "title": "Handwoven Cotton Throw", "price_cents": 4500, "stock": 8},
-    {"id": 4, "title": "Solid Oak Nightstand", "price_cents": 12000, "stock": 3},
-    {"id": 5, "title": "Artisanal Scented Candle", "price_cents": 1800, "stock": 25},
-    {"id": 6, "title": "Industrial Desk Lamp", "price_cents": 6500, "stock": 10},
-    {"id": 7, "title": "Velvet Accent Pillow", "price_cents": 2500, "stock": 15},
-    {"id": 8, "title": "Matte Black Pour-Over Kit", "price_cents": 4200, "stock": 7},
-    {"id": 9, "title": "Geometric Wall Mirror", "price_cents": 8500, "stock": 4},
-    {"id": 10, "title": "Recycled Glass Carafe", "price_cents": 2800, "stock": 20}
-]
\ No newline at end of file
+    stripe_signature = serializers.CharField(write_only=True)
@@ -1,40 +1,180 @@
-from mail_dispatch_api.services import sendmail_service
-from checkout_api.models import OrderItem, Order
+from mail_dispatch_api.services import sendmail_service, send_chunk, build_message
+from checkout_api.models import OrderItem, Order, Product, WebhookEvent
+from checkout_api.catalog import demo_products, bump_version
+from checkout_api.reservations import commit_stock, commit_stocks, release_stock, release_stocks
+from checkout_api.reciepts import render_reciept, render_reciepts
+from checkout_api.outbox import add_to_outbox, add_reciepts_to_outbox, SENDRECIEPT_TASK
+from checkout_api.event_store import recorded_webhook_event, mark_processed, claim_webhook_events, release_webhook_events
+import json
+from django.db import transaction
+
+WEBHOOK_EVENT_STATUSES = {
+    'payment_intent.succeeded': Order.PAID,
+    'payment_intent.payment_failed': Order.CANCELLED,
+}
+
+def apply_webhook_event_service(event_type, payment_intent_id):
+    if event_type not in WEBHOOK_EVENT_STATUSES:
+        return None
+
+    status = WEBHOOK_EVENT_STATUSES[event_type]
+
+    with transaction.atomic():
+        order_pk = Order.objects.transition(payment_intent_id, status)
+
+        if order_pk is None:
+            # only a missing order is an error, one that already left PENDING is left alone
+            if not Order.objects.filter(payment_intent_id=payment_intent_id).exists():
+                raise Order.DoesNotExist(f'No order for payment intent "{payment_intent_id}"')
+
+            return None
+
+        if status == Order.PAID:
+            commit_stock(payment_intent_id, order_pk)
+        else:
+            transaction.on_commit(lambda: release_stock(payment_intent_id))
+
+        # the receipt is committed with the status change, or not at all
+        add_to_outbox(SENDRECIEPT_TASK, order_pk)
+
+    return order_pk
+
+def process_webhook_event_service(event_id, event_type, payment_intent_id, payload):
+    # returns whether the event was new, and the order it changed
+    with recorded_webhook_event(event_id, event_type, payload) as is_new:
+        if not is_new:
+            return False, None
+
+        return True, apply_webhook_event_service(event_type, payment_intent_id)
+
+def apply_webhook_events_service(events):
+    # takes (event type, payment intent id) pairs, returns the pks of the orders that changed
+    payment_intent_ids = {}
+
+    for event_type, payment_intent_id in events:
+        if event_type in WEBHOOK_EVENT_STATUSES:
+            payment_intent_ids.setdefault(WEBHOOK_EVENT_STATUSES[event_type], []).append(payment_intent_id)
+
+    order_pks = []
+
+    with transaction.atomic():
+        # one UPDATE per status instead of one per event
+        for status, ids in payment_intent_ids.items():
+            transitioned = Order.objects.transition_many(ids, status)
+
+            if not transitioned:
+                continue
+
+            if status == Order.PAID:
+                commit_stocks(transitioned)
+            else:
+                hold_ids = list(transitioned)
+                transaction.on_commit(lambda hold_ids=hold_ids: release_stocks(hold_ids))
+
+            order_pks += transitioned.values()
+
+        add_reciepts_to_outbox(order_pks)
+
+    return order_pks
+
+def process_webhook_events_service(events):
+    # the batched process_webhook_event_service(), takes (event id, event type, payment intent id, payload) tuples
+    claimed = set(claim_webhook_events([(event_id, event_type, payload) for event_id, event_type, _, payload in events]))
+
+    try:
+        order_pks = apply_webhook_events_service([
+            (event_type, payment_intent_id) for event_id, event_type, payment_intent_id, _ in events if event_id in claimed
+        ])
+    except BaseException:
+        release_webhook_events(list(claimed))
+        raise
+
+    if claimed:
+        mark_processed(list(claimed))
+
+    return order_pks
+
+def replay_webhook_events_service(since, until, batch_size=500, include_processed=False):
+    # yields (event ids, order pks) batch by batch, each batch applied like a batch of the event stream
+    events = WebhookEvent.objects.filter(received_at__gte=since, received_at__lt=until)
+
+    if not include_processed:
+        events = events.filter(processed_at__isnull=True)
+
+    last_pk = 0
+
+    while True:
+        batch = list(events.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+
+        if not batch:
+            break
+
+        # events of payment intents without an order change nothing
+        order_pks = apply_webhook_events_service([
+            (event.event_type, json.loads(event.payload)['data']['object']['id']) for event in batch
+        ])
+
+        event_ids = [event.event_id for event in batch]
+        mark_processed(event_ids)
+        last_pk = batch[-1].pk
+
+        yield event_ids, order_pks
 
 def sendreciept_service(order_pk):
-    reciept = create_reciept(order_pk)
-    msg_content = "Order Receipt\n"
-    msg_content += "-----------------\n"
+    reciept = Order.objects.values_list('reciept', flat=True).get(pk=order_pk)
 
-    for item in reciept['items']:
-        msg_content += f"{item['title']} (x{item['quantity']}) - ${item['price']}\n"
+    # orders placed before the snapshot existed
+    if reciept is None:
+        reciept = create_reciept(order_pk)
 
-    msg_content += "-----------------\n"
-    msg_content += f"TOTAL: ${reciept['totals']}"
+    sendmail_service(reciept_email(reciept, *render_reciept(reciept)))
 
-    order = Order.objects.get(pk=order_pk)
+def sendreciepts_service(order_pks):
+    # bulk resends, one query for the snapshots and one template pass for all of them
+    reciepts = load_reciepts(order_pks)
 
-    email = {
+    if reciepts:
+        # one token bucket take and one SMTP session for the chunk, a retry resends only the orders that didn't go out
+        send_chunk(list(reciepts), [build_message(reciept_email(reciept, *rendered)) for reciept, rendered in zip(reciepts.values(), render_reciepts(reciepts.values()))])
+
+    return len(reciepts)
+
+def reciept_email(reciept, msg_content, html_content):
+    return {
         'msg_content': msg_content,
+        'html_content': html_content,
         'subject': 'Order paid for',
-        'recipient': order.contact_email
+        'recipient': reciept['recipient']
     }
 
-    sendmail_service(email)
+def load_reciepts(order_pks):
+    # {order pk: snapshot} in the order of order_pks, orders that don't exist are left out
+    snapshots = dict(Order.objects.filter(pk__in=order_pks).values_list('pk', 'reciept'))
+
+    return {order_pk: snapshots[order_pk] or create_reciept(order_pk) for order_pk in order_pks if order_pk in snapshots}
+
+def build_reciept(contact_email, order_items):
+    # items are listed like OrderItem's ordering, newest product first
+    order_items = sorted(order_items, key=lambda item: item.item_id, reverse=True)
 
+    return {
+        'recipient': contact_email,
+        'items': [[item.title, item.quantity, item.price] for item in order_items],
+        'totals': sum(item.price * item.quantity for item in order_items)
+    }
 
 def create_reciept(order_pk):
-    items = []
-    total_amount = 0
+    order = Order.objects.get(pk=order_pk)
 
-    order_items = OrderItem.objects.filter(order=order_pk)
+    return build_reciept(order.contact_email, OrderItem.objects.filter(order=order_pk))
 
-    for item in order_items:
-        total_amount += item.price * item.quantity
+def seedproducts_service():
+    if Product.objects.exists():
+        return 0
 
-        items.append({'title': item.title, 'quantity': item.quantity, 'price': item.price, 'total': item.price * item.quantity})
+    products = Product.objects.bulk_create([Product(title=product['title'], price_cents=product['price_cents'], stock=product['stock']) for product in demo_products])
 
-    return {
-        'items': items,
-        'totals': total_amount
-    }
\ No newline at end of file
+    # bulk_create skips the post_save signal
+    transaction.on_commit(bump_version)
+
+    return len(products)
@@ -0,0 +1,75 @@
+import os
+import time
+import threading
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from commerceproject import metrics
+
+stripe_api_key = os.environ.get('STRIPE_SECRET_KEY') or ''
+stripe_webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET') or ''
+
+stripe_request_seconds = metrics.histogram('stripe_request_duration_seconds', 'Latency of Stripe API calls.', ('operation', 'outcome'))
+
+client_lock = threading.Lock()
+# (pid, client), a forked worker must not reuse its parent's sockets
+stripe_client_state = (None, None)
+
+def build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE)
+    session.mount('https://', adapter)
+
+    return session
+
+def build_client():
+    http_client = stripe.RequestsClient(
+        timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+        session=build_session()
+    )
+
+    return stripe.StripeClient(stripe_api_key, http_client=http_client, max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES)
+
+def get_stripe_client():
+    global stripe_client_state
+
+    pid, client = stripe_client_state
+
+    if pid != os.getpid():
+        with client_lock:
+            pid, client = stripe_client_state
+
+            if pid != os.getpid():
+                client = build_client()
+                stripe_client_state = (os.getpid(), client)
+
+    return client
+
+def call_stripe(operation, request):
+    started = time.perf_counter()
+    outcome = 'error'
+
+    try:
+        response = request(get_stripe_client())
+        outcome = 'success'
+
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        stripe_request_seconds.observe(elapsed, operation=operation, outcome=outcome)
+        usage = metrics.current_usage.get()
+
+        if usage is not None:
+            usage.stripe_seconds += elapsed
+
+def create_payment_intent(**params):
+    return call_stripe('payment_intents.create', lambda client: client.v1.payment_intents.create(params=params))
+
+def construct_event(payload, sig_header):
+    # verification is local, but it goes through the same client as every other Stripe call
+    return get_stripe_client().construct_event(payload, sig_header, stripe_webhook_secret)
+
+def verify_signature(payload, sig_header):
+    # checks the signature without parsing the event
+    return stripe.WebhookSignature.verify_header(payload.decode('utf-8'), sig_header, stripe_webhook_secret, stripe.Webhook.DEFAULT_TOLERANCE)
@@ -1,8 +1,69 @@
 from celery import shared_task
-from checkout_api.services import sendreciept_service
+from django.conf import settings
+from checkout_api.services import sendreciept_service, sendreciepts_service, process_webhook_events_service
+from checkout_api.reservations import release_expired_holds
+from checkout_api.event_stream import read_webhook_events, ack_webhook_events
+from checkout_api.outbox import relay_outbox
+from mail_dispatch_api.tasks import send_or_defer
+from commerceproject.celery import FIRE_AND_FORGET
+import os
+import json
+import socket
+import logging
 
-@shared_task
-def sendreciept_task(data):
-    return sendreciept_service(data)
+logger = logging.getLogger(__name__)
 
+@shared_task(bind=True, max_retries=settings.MAIL_MAX_RETRIES, **FIRE_AND_FORGET)
+def sendreciept_task(self, data):
+    return send_or_defer(self, sendreciept_service, data)
 
+@shared_task(bind=True, max_retries=settings.MAIL_MAX_RETRIES, **FIRE_AND_FORGET)
+def sendreciepts_task(self, order_pks):
+    return send_or_defer(self, sendreciepts_service, order_pks)
+
+@shared_task(**FIRE_AND_FORGET)
+def release_expired_holds_task():
+    return release_expired_holds()
+
+@shared_task(**FIRE_AND_FORGET)
+def relay_outbox_task(max_batches=10):
+    relayed = 0
+
+    for _ in range(max_batches):
+        count = relay_outbox()
+        relayed += count
+
+        if count < settings.OUTBOX_BATCH_SIZE:
+            break
+
+    return relayed
+
+@shared_task(**FIRE_AND_FORGET)
+def consume_webhook_events_task(max_batches=10):
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    processed = 0
+
+    for _ in range(max_batches):
+        entries = read_webhook_events(consumer, settings.STRIPE_EVENT_BATCH_SIZE)
+
+        if not entries:
+            break
+
+        events = []
+
+        for entry_id, payload in entries:
+            try:
+                event = json.loads(payload)
+                events.append((event['id'], event['type'], event['data']['object']['id'], payload))
+            except (ValueError, KeyError):
+                # retrying won't fix these, so they get acknowledged too
+                logger.warning('Skipping webhook event %s that could not be parsed.', entry_id, exc_info=True)
+
+        # if this raises nothing is acknowledged, and the whole batch gets claimed again by a later run,
+        # the receipts are in the outbox once it returns
+        process_webhook_events_service(events)
+        done = [entry_id for entry_id, _ in entries]
+        ack_webhook_events(done)
+        processed += len(done)
+
+    return processed
@@ -0,0 +1,59 @@
+from django.test import TestCase
+from checkout_api.models import Product
+from checkout_api.catalog import demo_products, bump_version, get_catalog_version, get_product, get_products, get_products_by_id, resolve_cart
+
+class CatalogTestCase(TestCase):
+    def setUp(self):
+        bump_version()
+
+    def tearDown(self):
+        # drop whatever this test cached, the rows it created are rolled back
+        bump_version()
+
+    def test_get_products(self):
+        self.assertEqual(get_products(), demo_products)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_products(), demo_products)
+
+    def test_get_product(self):
+        for product in demo_products:
+            self.assertEqual(get_product(product['id']), product)
+
+        self.assertIsNone(get_product(123))
+
+    def test_get_products_by_id(self):
+        products = get_products_by_id([2, 123, 1])
+
+        self.assertEqual(len(products), 3)
+        self.assertEqual(products[1], demo_products[0])
+        self.assertEqual(products[2], demo_products[1])
+        self.assertIsNone(products[123])
+
+    def test_resolve_cart(self):
+        cart_items = [{'product_id': 1, 'product_quantity': 4}, {'product_id': 2, 'product_quantity': 6}]
+
+        resolved = resolve_cart(cart_items)
+
+        self.assertEqual(len(resolved), 2)
+        self.assertEqual(resolved[0], (cart_items[0], demo_products[0]))
+        self.assertEqual(resolved[1], (cart_items[1], demo_products[1]))
+
+    def test_invalidation(self):
+        version = get_catalog_version()
+        self.assertEqual(get_product(1)['price_cents'], 5500)
+
+        product = Product.objects.get(pk=1)
+        product.price_cents = 6000
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+
+        self.assertEqual(get_catalog_version(), version + 1)
+        self.assertEqual(get_product(1)['price_cents'], 6000)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            new_product = Product.objects.create(title='Test', price_cents=1000, stock=2)
+
+        self.assertEqual(get_product(new_product.pk), {'id': new_product.pk, 'title': 'Test', 'price_cents': 1000, 'stock': 2})
+        self.assertEqual(len(get_products()), len(demo_products) + 1)
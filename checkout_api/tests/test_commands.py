@@ -25,4 +25,145 @@
 
 #         mock_service.assert_called_once()
 
-#         self.assertIn('Successfully created 10 example products', out.getvalue())
\ No newline at end of file
+#         self.assertIn('Successfully created 10 example products', out.getvalue())
+
+from django.test import TestCase, tag
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from checkout_api.models import Order, WebhookEvent, OutboxMessage
+from checkout_api.services import apply_webhook_events_service
+from checkout_api.outbox import SENDRECIEPTS_TASK
+from checkout_api.management.commands.benchmark_serving import Command, free_port
+from unittest import skipUnless
+from unittest.mock import patch, MagicMock
+from io import StringIO
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import json
+import socket
+import threading
+
+class ReplayWebhookEventsCommandTestCase(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='123')
+        self.since = timezone.now() - timedelta(minutes=1)
+
+        for index, event_type in enumerate(['payment_intent.succeeded', 'payment_intent.succeeded', 'payment_intent.payment_failed']):
+            payload = json.dumps({'id': f'evt_replay_{index}', 'type': event_type, 'data': {'object': {'id': '123' if index < 2 else 'unknown'}}})
+            WebhookEvent.objects.create(event_id=f'evt_replay_{index}', event_type=event_type, payload=payload)
+
+        WebhookEvent.objects.filter(event_id='evt_replay_0').update(processed_at=timezone.now())
+
+    def test_output(self):
+        out = StringIO()
+        call_command('replay_webhook_events', since=self.since.isoformat(), batch_size=1, stdout=out)
+
+        self.assertIn('Successfully replayed "2" webhook events', out.getvalue())
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAID)
+        self.assertEqual(WebhookEvent.objects.filter(processed_at__isnull=True).count(), 0)
+
+        # one receipt, the unknown payment intent has no order
+        self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')), [(SENDRECIEPTS_TASK, [[self.order.pk]])])
+
+        out = StringIO()
+        call_command('replay_webhook_events', since=self.since.isoformat(), stdout=out)
+        self.assertIn('Successfully replayed "0" webhook events', out.getvalue())
+
+        out = StringIO()
+        call_command('replay_webhook_events', since=self.since.isoformat(), include_processed=True, stdout=out)
+        self.assertIn('Successfully replayed "3" webhook events', out.getvalue())
+
+    def test_batches(self):
+        WebhookEvent.objects.update(processed_at=None)
+
+        with patch('checkout_api.services.apply_webhook_events_service', wraps=apply_webhook_events_service) as mock_apply:
+            call_command('replay_webhook_events', since=self.since.isoformat(), batch_size=2, stdout=StringIO())
+
+        # one bulk apply per batch, not one per event
+        self.assertEqual([len(call.args[0]) for call in mock_apply.call_args_list], [2, 1])
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAID)
+
+class RelayOutboxCommandTestCase(TestCase):
+    @patch('checkout_api.outbox.app.send_task')
+    def test_output(self, mock_send_task):
+        OutboxMessage.objects.bulk_create([OutboxMessage(task='checkout_api.tasks.sendreciept_task', args=[index]) for index in range(5)])
+
+        out = StringIO()
+        call_command('relay_outbox', batch_size=2, stdout=out)
+
+        self.assertIn('Successfully relayed "5" outbox messages', out.getvalue())
+        self.assertEqual(mock_send_task.call_count, 5)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+class BenchmarkServingCommandTestCase(TestCase):
+    @patch.object(Command, 'measure', side_effect=[(100.0, 0.02, 0), (250.0, 0.01, 1)])
+    @patch.object(Command, 'wait_until_ready')
+    @patch('checkout_api.management.commands.benchmark_serving.subprocess.Popen')
+    def test_output(self, mock_popen, mock_wait_until_ready, mock_measure):
+        out = StringIO()
+        call_command('benchmark_serving', requests=20, concurrency=2, path='/', stdout=out)
+
+        commands = [call.args[0] for call in mock_popen.call_args_list]
+        self.assertIn('runserver', commands[0])
+        self.assertIn('gunicorn', commands[1])
+        # both servers are shut down gracefully
+        self.assertEqual(mock_popen.return_value.terminate.call_count, 2)
+        self.assertEqual(mock_measure.call_args.args[1:], ('/', 20, 2))
+
+        self.assertIn('runserver: 100.0 requests/s, p99 20.0 ms, 0 errors', out.getvalue())
+        self.assertIn('gunicorn: 250.0 requests/s, p99 10.0 ms, 1 errors', out.getvalue())
+        self.assertIn('Successfully served "20" requests, 2.5x faster with gunicorn', out.getvalue())
+
+    def test_wait_until_ready(self):
+        process = MagicMock()
+        process.poll.return_value = None
+
+        with socket.create_server(('127.0.0.1', 0)) as server:
+            Command().wait_until_ready('test', process, server.getsockname()[1])
+
+        process.poll.return_value = 1
+        process.returncode = 1
+
+        with self.assertRaisesMessage(CommandError, 'test exited with 1 before serving'):
+            Command().wait_until_ready('test', process, free_port())
+
+    def test_measure(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), OkHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        throughput, p99, errors = Command().measure(server.server_address[1], '/', 20, 2)
+
+        self.assertEqual(server.requests, 20)
+        self.assertGreater(throughput, 0)
+        self.assertGreater(p99, 0)
+        self.assertEqual(errors, 0)
+
+class OkHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the servers the benchmark compares
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests = getattr(self.server, 'requests', 0) + 1
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'[]')
+
+    def log_message(self, *args):
+        pass
+
+# starts real runserver and gunicorn processes, run with RUN_INTEGRATION_TESTS=1 or --tag integration
+@tag('integration')
+@skipUnless(os.environ.get('RUN_INTEGRATION_TESTS'), 'starts real servers, set RUN_INTEGRATION_TESTS=1 to run it')
+class BenchmarkServingIntegrationTestCase(TestCase):
+    def test_output(self):
+        out = StringIO()
+        call_command('benchmark_serving', requests=20, concurrency=2, path='/', stdout=out)
+
+        self.assertIn('runserver: ', out.getvalue())
+        self.assertIn('gunicorn: ', out.getvalue())
+        self.assertIn('Successfully served "20" requests', out.getvalue())
@@ -0,0 +1,38 @@
+from django.test import TestCase
+from django.db import connection, connections
+from commerceproject.db.base import connect_seconds, connections_opened, connections_open, health_check_failures
+
+class DatabaseConnectionTestCase(TestCase):
+    def setUp(self):
+        for metric in (connect_seconds, connections_opened, connections_open, health_check_failures):
+            metric.reset()
+
+    def test_settings(self):
+        self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], 600)
+        self.assertTrue(connection.settings_dict['CONN_HEALTH_CHECKS'])
+        self.assertFalse(connection.settings_dict['DISABLE_SERVER_SIDE_CURSORS'])
+
+    def test_metrics(self):
+        # a connection of its own, the test's one is inside a transaction
+        wrapper = connections.create_connection('default')
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+
+        self.assertEqual(connections_opened.get(alias='default'), 1)
+        self.assertEqual(connections_open.get(alias='default'), 1)
+        self.assertEqual(connect_seconds.get_count(alias='default'), 1)
+
+        # still usable, nothing is replaced
+        wrapper.close_if_health_check_failed()
+        self.assertEqual(health_check_failures.get(alias='default'), 0)
+
+        # the server drops it between two requests
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [wrapper.connection.get_backend_pid()])
+
+        wrapper.health_check_done = False
+        wrapper.close_if_health_check_failed()
+
+        self.assertEqual(health_check_failures.get(alias='default'), 1)
+        self.assertEqual(connections_open.get(alias='default'), 0)
+        self.assertIsNone(wrapper.connection)
@@ -0,0 +1,103 @@
+from unittest.mock import patch
+from django.test import TestCase
+from rest_framework.test import APIClient
+from commerceproject import metrics
+from commerceproject.metrics_store import MetricsStore, metrics_store, store_client, totals_key, gauges_key, gauges_expiry_key
+from commerceproject.instrumentation import http_request_seconds, http_request_db_queries, http_request_redis_round_trips, task_seconds, task_db_queries
+from commerceproject.redis_client import redis_seconds
+from checkout_api.catalog import bump_version
+from checkout_api.tasks import release_expired_holds_task
+import json
+import time
+import redis
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+        for metric in metrics.registry.values():
+            metric.reset()
+
+        # other processes of the test database, earlier runs included
+        store_client.delete(totals_key(), gauges_key(), gauges_expiry_key())
+        metrics_store.pushed = {}
+
+    def tearDown(self):
+        store_client.delete(totals_key(), gauges_key(), gauges_expiry_key())
+
+    def test_request_metrics(self):
+        bump_version()
+        route = '/api/checkout/demo-products/'
+
+        response = self.client.get(route)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(http_request_seconds.get_count(route=route, method='GET', status=200), 1)
+        # the product list is read from Postgres and cached in Redis
+        self.assertGreater(http_request_db_queries.collect()[(route,)][1], 0)
+        self.assertGreater(http_request_redis_round_trips.collect()[(route,)][1], 0)
+        self.assertGreater(redis_seconds.get_count(command='PIPELINE') + redis_seconds.get_count(command='GET'), 0)
+
+        self.client.get('/no-such-page/')
+        self.assertEqual(http_request_seconds.get_count(route='unmatched', method='GET', status=404), 1)
+
+    def test_task_metrics(self):
+        release_expired_holds_task.apply()
+
+        self.assertEqual(task_seconds.get_count(task=release_expired_holds_task.name, state='SUCCESS'), 1)
+        self.assertEqual(task_db_queries.get_count(task=release_expired_holds_task.name), 1)
+
+    def test_render(self):
+        counter = metrics.counter('test_render_total', 'A "test" counter.', ('path',))
+        self.addCleanup(metrics.registry.pop, 'test_render_total')
+        counter.inc(2, path='/a"b')
+
+        text = metrics.render()
+
+        self.assertIn('# TYPE test_render_total counter', text)
+        self.assertIn('test_render_total{path="/a\\"b"} 2', text)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+
+        http_request_seconds.observe(0.02, route='/', method='GET', status=200)
+        text = metrics.render()
+
+        self.assertIn('http_request_duration_seconds_bucket{route="/",method="GET",status="200",le="0.01"} 0', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/",method="GET",status="200",le="0.025"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/",method="GET",status="200",le="+Inf"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{route="/",method="GET",status="200"} 1', text)
+
+    def test_metrics_endpoint(self):
+        mail_sent = metrics.registry['mail_messages_sent_total']
+        buffer_size = metrics.registry['task_publish_buffer_size']
+        mail_sent.inc(3, host='relay.test')
+        buffer_size.set(2)
+
+        # what another process pushed
+        store_client.hincrbyfloat(totals_key(), json.dumps(['mail_messages_sent_total', ['relay.test'], None]), 4)
+        store_client.hset(gauges_key(), mapping={'other': json.dumps({'task_publish_buffer_size': [[[], 5]]}), 'gone': json.dumps({'task_publish_buffer_size': [[[], 100]]})})
+        # "gone" stopped pushing a while ago
+        store_client.zadd(gauges_expiry_key(), {'other': time.time() + 60, 'gone': time.time() - 1})
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+        text = response.content.decode()
+        self.assertIn('mail_messages_sent_total{host="relay.test"} 7', text)
+        self.assertIn('task_publish_buffer_size 7', text)
+        self.assertCountEqual(store_client.hkeys(gauges_key()), ['other', metrics_store.process])
+
+        # only what's new since the last push is added again
+        mail_sent.inc(1, host='relay.test')
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('mail_messages_sent_total{host="relay.test"} 8', text)
+
+    @patch('commerceproject.metrics_store.time.sleep')
+    def test_push_thread_survives_errors(self, mock_sleep):
+        store = MetricsStore()
+
+        with patch.object(store, 'push', side_effect=[redis.exceptions.ConnectionError(), TypeError(), SystemExit()]) as mock_push:
+            with self.assertRaises(SystemExit), self.assertLogs('commerceproject.metrics_store', 'WARNING'):
+                store.run()
+
+        self.assertEqual(mock_push.call_count, 3)
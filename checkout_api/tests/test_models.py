@@ -1,7 +1,16 @@
 from django.test import TestCase
-from checkout_api.models import Order, OrderItem
+from checkout_api.models import Order, OrderItem, Product, encode_order_number, order_number_allocator
 from decimal import *
 
+class ProductTestCase(TestCase):
+    def test_seeded_products(self):
+        self.assertEqual(Product.objects.count(), 10)
+
+    def test_str_method(self):
+        product = Product.objects.create(title='Test', price_cents=1200, stock=4)
+
+        self.assertEqual(product.__str__(), f"Product: {product.title}")
+
 class OrderTestCase(TestCase):
     def setUp(self):
         self.order = Order.objects.create(status=Order.PAID,
@@ -29,6 +38,45 @@ class OrderTestCase(TestCase):
         
         self.assertNotEqual(self.order.order_number, order.order_number)
 
+    def test_order_number(self):
+        self.assertEqual(len(self.order.order_number), len('ORD-') + 7)
+
+        order_numbers = {encode_order_number(value) for value in range(10000)}
+        self.assertEqual(len(order_numbers), 10000)
+
+        # the next length starts once the seven character range runs out
+        self.assertEqual(len(encode_order_number(36 ** 7)), len('ORD-') + 8)
+
+    def test_save_queries(self):
+        order_number_allocator.reset()
+
+        # one nextval() for the block, then only the INSERT
+        with self.assertNumQueries(2):
+            Order.objects.create(total=4599, contact_email='johndoe@example.com', payment_intent_id='456')
+
+        with self.assertNumQueries(1):
+            Order.objects.create(total=4599, contact_email='johndoe@example.com', payment_intent_id='654')
+
+    def test_transition(self):
+        order = Order.objects.create(total=4599, contact_email='johndoe@example.com', payment_intent_id='789')
+
+        # no SELECT before the UPDATE
+        with self.assertNumQueries(1):
+            self.assertEqual(Order.objects.transition('789', Order.PAID), order.pk)
+
+        saved_order = Order.objects.get(pk=order.pk)
+        self.assertEqual(saved_order.status, Order.PAID)
+        self.assertEqual(saved_order.date_placed, order.date_placed)
+
+        # only PENDING orders move
+        self.assertIsNone(Order.objects.transition('789', Order.PAID))
+        self.assertIsNone(Order.objects.transition('789', Order.CANCELLED))
+        self.assertIsNone(Order.objects.transition('missing', Order.PAID))
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.PAID)
+
+        with self.assertRaises(ValueError):
+            Order.objects.transition('789', Order.SHIPPED)
+
     def test_str_method(self):
         order = Order.objects.get(order_number=self.order.order_number)
 
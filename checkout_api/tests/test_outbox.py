@@ -0,0 +1,50 @@
+from django.test import TestCase
+from django.db import transaction
+from unittest.mock import patch
+from checkout_api.models import Order, OutboxMessage
+from checkout_api.outbox import add_to_outbox, add_reciepts_to_outbox, relay_outbox, SENDRECIEPT_TASK, SENDRECIEPTS_TASK
+from checkout_api.services import apply_webhook_event_service
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='123')
+
+    def test_written_with_the_status(self):
+        # a status change that rolls back leaves no receipt behind
+        with patch('checkout_api.services.commit_stock', side_effect=RuntimeError('error, bro')):
+            with self.assertRaises(RuntimeError):
+                apply_webhook_event_service('payment_intent.succeeded', '123')
+
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PENDING)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+        apply_webhook_event_service('payment_intent.succeeded', '123')
+
+        self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')), [(SENDRECIEPT_TASK, [self.order.pk])])
+
+    @patch('checkout_api.outbox.app.send_task')
+    def test_relay_outbox(self, mock_send_task):
+        with transaction.atomic():
+            add_to_outbox(SENDRECIEPT_TASK, self.order.pk)
+
+        with self.settings(RECEIPT_CHUNK_SIZE=2):
+            add_reciepts_to_outbox([1, 2, 3])
+
+        self.assertEqual(relay_outbox(batch_size=2), 2)
+        self.assertEqual([call.args for call in mock_send_task.call_args_list], [(SENDRECIEPT_TASK,), (SENDRECIEPTS_TASK,)])
+        self.assertEqual([call.kwargs['args'] for call in mock_send_task.call_args_list], [[self.order.pk], [[1, 2]]])
+
+        self.assertEqual(relay_outbox(), 1)
+        self.assertEqual(mock_send_task.call_args.kwargs['args'], [[3]])
+
+        self.assertEqual(relay_outbox(), 0)
+
+    @patch('checkout_api.outbox.app.send_task', side_effect=ConnectionError('broker is down'))
+    def test_relay_failure(self, mock_send_task):
+        add_to_outbox(SENDRECIEPT_TASK, self.order.pk)
+
+        # nothing is lost when the broker can't be reached
+        with self.assertRaises(ConnectionError):
+            relay_outbox()
+
+        self.assertEqual(OutboxMessage.objects.count(), 1)
@@ -0,0 +1,119 @@
+from unittest.mock import patch
+from django.test import TestCase, override_settings
+from checkout_api.models import Order, OrderItem, Product
+from checkout_api.catalog import bump_version, build_catalog, get_catalog, get_catalog_version
+from checkout_api.reservations import reserve_stock, rename_hold, release_stock, release_expired_holds, commit_stock, stock_prefix
+from commerceproject.redis_client import rd_instance
+
+class ReservationTestCase(TestCase):
+    def setUp(self):
+        bump_version()
+        self.hold_ids = []
+
+    def tearDown(self):
+        for hold_id in self.hold_ids:
+            release_stock(hold_id)
+
+        bump_version()
+
+    def reserve(self, cart_items):
+        hold_id = reserve_stock(cart_items)
+
+        if isinstance(hold_id, str):
+            self.hold_ids.append(hold_id)
+
+        return hold_id
+
+    def held(self, product_id):
+        return int(rd_instance.get(f'{stock_prefix()}held:{product_id}') or 0)
+
+    def test_reserve_stock(self):
+        # product 1 has 5 in stock
+        hold_id = self.reserve([{'product_id': 1, 'product_quantity': 4}, {'product_id': 2, 'product_quantity': 6}])
+
+        self.assertIsInstance(hold_id, str)
+        self.assertEqual(self.held(1), 4)
+        self.assertEqual(self.held(2), 6)
+
+        # nothing gets held when one of the lines is short
+        result = self.reserve([{'product_id': 2, 'product_quantity': 1}, {'product_id': 1, 'product_quantity': 2}])
+
+        self.assertEqual(result, {'cart_items': "Product with id 1 doesn't have enough stock left."})
+        self.assertEqual(self.held(2), 6)
+
+        self.assertTrue(release_stock(hold_id))
+        self.assertFalse(release_stock(hold_id))
+        self.assertEqual(self.held(1), 0)
+        self.assertEqual(self.held(2), 0)
+
+        self.assertIsInstance(self.reserve([{'product_id': 1, 'product_quantity': 5}]), str)
+
+    def test_reserve_stock_stale_catalog(self):
+        # a process still holding the catalog from before product 1 sold out
+        stale_catalog = build_catalog(get_catalog_version() - 1, [{'id': 1, 'title': 'Abstract Horizon Painting', 'price_cents': 5500, 'stock': 100}])
+
+        with patch('checkout_api.reservations.get_catalog', side_effect=[stale_catalog, get_catalog()]) as mock_get_catalog:
+            result = self.reserve([{'product_id': 1, 'product_quantity': 6}])
+
+        # the stale stock is rejected and the retry checks against the current one
+        self.assertEqual(mock_get_catalog.call_count, 2)
+        self.assertEqual(result, {'cart_items': "Product with id 1 doesn't have enough stock left."})
+        self.assertEqual(self.held(1), 0)
+
+    def test_reserve_stock_deleted_product(self):
+        stale_catalog = build_catalog(get_catalog_version() - 1, [{'id': 1, 'title': 'Abstract Horizon Painting', 'price_cents': 5500, 'stock': 5}])
+
+        with patch('checkout_api.reservations.get_catalog', side_effect=[stale_catalog, build_catalog(get_catalog_version(), [])]):
+            result = self.reserve([{'product_id': 1, 'product_quantity': 1}])
+
+        self.assertEqual(result, {'cart_items': "Product with id 1 doesn't exist."})
+        self.assertEqual(self.held(1), 0)
+
+    def test_rename_hold(self):
+        hold_id = self.reserve([{'product_id': 1, 'product_quantity': 2}])
+
+        self.assertTrue(rename_hold(hold_id, 'pi_123'))
+        self.hold_ids.append('pi_123')
+        self.assertFalse(rename_hold(hold_id, 'pi_123'))
+
+        self.assertTrue(release_stock('pi_123'))
+        self.assertEqual(self.held(1), 0)
+
+    @override_settings(STOCK_HOLD_TTL=-1)
+    def test_release_expired_holds(self):
+        self.reserve([{'product_id': 1, 'product_quantity': 5}])
+        self.assertEqual(self.held(1), 5)
+
+        self.assertGreaterEqual(release_expired_holds(), 1)
+        self.assertEqual(self.held(1), 0)
+
+        # expired holds are also dropped before a new reservation
+        self.reserve([{'product_id': 1, 'product_quantity': 5}])
+        self.assertIsInstance(self.reserve([{'product_id': 1, 'product_quantity': 5}]), str)
+
+    def test_commit_stock(self):
+        order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='pi_123')
+        hold_id = self.reserve([{'product_id': 1, 'product_quantity': 4}])
+        rename_hold(hold_id, 'pi_123')
+        self.hold_ids.append('pi_123')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            quantities = commit_stock('pi_123', order.pk)
+
+        self.assertEqual(quantities, {1: 4})
+        self.assertEqual(Product.objects.get(pk=1).stock, 1)
+        self.assertEqual(self.held(1), 0)
+
+        # only one left for the next buyer
+        result = self.reserve([{'product_id': 1, 'product_quantity': 2}])
+        self.assertEqual(result, {'cart_items': "Product with id 1 doesn't have enough stock left."})
+
+    def test_commit_expired_stock(self):
+        order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='pi_123')
+        OrderItem.objects.create(item_id=2, title='Minimalist Ceramic Vase', price=3200, quantity=20, order=order)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            quantities = commit_stock('pi_123', order.pk)
+
+        self.assertEqual(quantities, {2: 20})
+        self.assertEqual(Product.objects.get(pk=2).stock, 0)
@@ -1,7 +1,8 @@
-from checkout_api.services import sendreciept_service
+from checkout_api.services import sendreciept_service, sendreciepts_service, process_webhook_events_service, build_reciept
 from django.test import TestCase
-from checkout_api.models import Order, OrderItem
-from unittest.mock import patch
+from checkout_api.models import Order, OrderItem, WebhookEvent
+from unittest.mock import patch, ANY
+import uuid
 
 class SendRecieptServiceTestCase(TestCase):
     def setUp(self):
@@ -14,4 +15,67 @@ class SendRecieptServiceTestCase(TestCase):
     def test_return(self, mock_mail):
         sendreciept_service(self.order.pk)
 
-        mock_mail.assert_called_once_with({'msg_content': 'Order Receipt\n-----------------\nHandwoven Cotton Throw (x2) - $4500\nMinimalist Ceramic Vase (x10) - $3200\nAbstract Horizon Painting (x4) - $5500\n-----------------\nTOTAL: $63000', 'subject': 'Order paid for', 'recipient': 'test@test.com'})
\ No newline at end of file
+        mock_mail.assert_called_once_with({'msg_content': 'Order Receipt\n-----------------\nHandwoven Cotton Throw (x2) - $4500\nMinimalist Ceramic Vase (x10) - $3200\nAbstract Horizon Painting (x4) - $5500\n-----------------\nTOTAL: $63000', 'html_content': ANY, 'subject': 'Order paid for', 'recipient': 'test@test.com'})
+
+    @patch('checkout_api.services.sendmail_service')
+    def test_reciept_snapshot(self, mock_mail):
+        reciept = build_reciept(self.order.contact_email, OrderItem.objects.filter(order=self.order))
+        Order.objects.filter(pk=self.order.pk).update(reciept=reciept)
+
+        # the snapshot is the only read
+        with self.assertNumQueries(1):
+            sendreciept_service(self.order.pk)
+
+        self.assertEqual(mock_mail.call_args.args[0]['msg_content'], 'Order Receipt\n-----------------\nHandwoven Cotton Throw (x2) - $4500\nMinimalist Ceramic Vase (x10) - $3200\nAbstract Horizon Painting (x4) - $5500\n-----------------\nTOTAL: $63000')
+
+    @patch('checkout_api.services.sendmail_service')
+    def test_html_content(self, mock_mail):
+        Order.objects.filter(pk=self.order.pk).update(reciept={'recipient': 'test@test.com', 'items': [['Vase <b>', 2, 3200]], 'totals': 6400})
+
+        sendreciept_service(self.order.pk)
+
+        email = mock_mail.call_args.args[0]
+        # titles are only escaped in the HTML alternative
+        self.assertIn('Vase <b> (x2) - $3200', email['msg_content'])
+        self.assertIn('Vase &lt;b&gt;', email['html_content'])
+        self.assertIn('$6400', email['html_content'])
+
+    @patch('checkout_api.services.send_chunk')
+    def test_sendreciepts_service(self, mock_mail):
+        order = Order.objects.create(contact_email='other@test.com', total=2500, payment_intent_id='456',
+            reciept={'recipient': 'other@test.com', 'items': [['Vase', 1, 2500]], 'totals': 2500})
+
+        # one query for the snapshots, plus two for the order placed before them
+        with self.assertNumQueries(3):
+            self.assertEqual(sendreciepts_service([self.order.pk, order.pk, 0]), 2)
+
+        # a partly sent chunk is retried by order pk
+        order_pks, messages = mock_mail.call_args.args
+        self.assertEqual(order_pks, [self.order.pk, order.pk])
+        self.assertEqual([message.to for message in messages], [['test@test.com'], ['other@test.com']])
+        self.assertTrue(messages[1].body.endswith('TOTAL: $2500'))
+
+class ProcessWebhookEventsServiceTestCase(TestCase):
+    def setUp(self):
+        self.orders = [Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id=f'pi_batch_{index}') for index in range(4)]
+
+    def event(self, event_type, payment_intent_id, event_id=None):
+        event_id = event_id or f'evt_{uuid.uuid4().hex}'
+        return (event_id, event_type, payment_intent_id, f'{{"id": "{event_id}"}}')
+
+    def test_return(self):
+        events = [self.event('payment_intent.succeeded', f'pi_batch_{index}') for index in range(3)]
+        events.append(self.event('payment_intent.payment_failed', 'pi_batch_3'))
+        events.append(self.event('payment_intent.succeeded', 'unknown'))
+
+        order_pks = process_webhook_events_service(events)
+
+        self.assertEqual(sorted(order_pks), sorted(order.pk for order in self.orders))
+        self.assertEqual(Order.objects.filter(status=Order.PAID).count(), 3)
+        self.assertEqual(Order.objects.get(payment_intent_id='pi_batch_3').status, Order.CANCELLED)
+        self.assertEqual(WebhookEvent.objects.filter(processed_at__isnull=False).count(), 5)
+
+        # redelivered events and orders that already left PENDING change nothing
+        self.assertEqual(process_webhook_events_service(events[:2]), [])
+        self.assertEqual(process_webhook_events_service([self.event('payment_intent.payment_failed', 'pi_batch_0')]), [])
+        self.assertEqual(Order.objects.get(payment_intent_id='pi_batch_0').status, Order.PAID)
@@ -0,0 +1,42 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+from checkout_api import stripe_gateway
+from checkout_api.stripe_gateway import get_stripe_client, create_payment_intent, stripe_request_seconds
+import stripe
+
+class StripeGatewayTestCase(TestCase):
+    def setUp(self):
+        stripe_gateway.stripe_client_state = (None, None)
+        stripe_request_seconds.reset()
+
+    def tearDown(self):
+        stripe_gateway.stripe_client_state = (None, None)
+
+    @override_settings(STRIPE_CONNECT_TIMEOUT=1, STRIPE_READ_TIMEOUT=5, STRIPE_MAX_NETWORK_RETRIES=3)
+    def test_get_stripe_client(self):
+        client = get_stripe_client()
+
+        # reused for every call in the same process
+        self.assertIs(get_stripe_client(), client)
+
+        requestor = client._requestor
+        self.assertEqual(requestor._client._timeout, (1, 5))
+        self.assertIsNotNone(requestor._client._session)
+        self.assertEqual(client._requestor._options.max_network_retries, 3)
+
+    @patch('checkout_api.stripe_gateway.get_stripe_client')
+    def test_create_payment_intent(self, mock_client):
+        mock_client.return_value.v1.payment_intents.create.return_value = {'id': '321'}
+
+        intent = create_payment_intent(amount=1200, currency='usd')
+
+        self.assertEqual(intent, {'id': '321'})
+        mock_client.return_value.v1.payment_intents.create.assert_called_once_with(params={'amount': 1200, 'currency': 'usd'})
+        self.assertEqual(stripe_request_seconds.get_count(operation='payment_intents.create', outcome='success'), 1)
+
+        mock_client.return_value.v1.payment_intents.create.side_effect = stripe.error.APIConnectionError('timed out')
+
+        with self.assertRaises(stripe.error.APIConnectionError):
+            create_payment_intent(amount=1200, currency='usd')
+
+        self.assertEqual(stripe_request_seconds.get_count(operation='payment_intents.create', outcome='error'), 1)
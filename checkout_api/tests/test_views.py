@@ -1,7 +1,15 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from rest_framework.test import APIClient
-from checkout_api.models import Order, OrderItem
-from checkout_api.views import demo_products
+from checkout_api.models import Order, OrderItem, Product, WebhookEvent, OutboxMessage
+from checkout_api.outbox import SENDRECIEPT_TASK, SENDRECIEPTS_TASK
+from checkout_api.catalog import demo_products, bump_version
+from checkout_api.reservations import reserve_stock, rename_hold, release_stock
+from checkout_api.idempotency import idempotency_key, fingerprint_request
+from checkout_api.event_stream import stream_key
+from checkout_api.event_store import event_key
+from checkout_api.tasks import consume_webhook_events_task
+from checkout_api.services import process_webhook_events_service
+from commerceproject.instrumentation import http_request_redis_round_trips
 from decimal import *
 from django.urls import reverse
 from unittest.mock import patch
@@ -11,6 +19,10 @@ import redis
 from django.conf import settings
 import stripe
 from types import SimpleNamespace
+import gzip
+import json
+from django.db import DatabaseError
+import uuid
 
 # rd_instance = redis.Redis(host='redis://127.0.0.1', port=6379, decode_responses=True)
 rd_instance = redis.Redis.from_url(settings.CELERY_BROKER_URL, decode_responses=True)
@@ -18,6 +30,7 @@ rd_instance = redis.Redis.from_url(settings.CELERY_BROKER_URL, decode_responses=
 class ProductListView(TestCase):
     def setUp(self):
         self.client = APIClient()
+        bump_version()
 
     def test_get(self):
         url = f'/api/checkout/demo-products/'
@@ -29,11 +42,46 @@ class ProductListView(TestCase):
         for index, item in enumerate(response.json()):
             self.assertEqual(item, demo_products[index])    
 
+    def test_conditional_get(self):
+        url = f'/api/checkout/demo-products/'
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['ETag'])
+        self.assertEqual(response.headers['Cache-Control'], f'public, max-age={settings.PRODUCT_LIST_MAX_AGE}')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        etag = response.headers['ETag']
+
+        # served from the rendered cache without a query
+        with self.assertNumQueries(0):
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.client.get(url, headers={'If-None-Match': '"something-else"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_gzip(self):
+        url = f'/api/checkout/demo-products/'
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content)), demo_products)
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
 class PlaceOrderTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
 
-    @patch('checkout_api.views.stripe.PaymentIntent.create')
+    def tearDown(self):
+        release_stock('321')
+
+    @patch('checkout_api.views.create_payment_intent')
     def test_post(self, mock_stripe):
         mock_stripe.return_value = {
             'client_secret': '123',
@@ -73,6 +121,9 @@ class PlaceOrderTestCase(TestCase):
         self.assertEqual(saved_order.total, 41200)
         self.assertEqual(saved_order.contact_email, data['order']['contact_email'])
         self.assertEqual(saved_order.status, Order.PENDING)
+        self.assertEqual(saved_order.reciept['recipient'], 'test@test.com')
+        self.assertEqual([item[1] for item in saved_order.reciept['items']], [6, 4])
+        self.assertEqual(saved_order.reciept['totals'], 41200)
 
         order_items = OrderItem.objects.all()
 
@@ -80,20 +131,210 @@ class PlaceOrderTestCase(TestCase):
         self.assertEqual(order_items[0].item_id, data['cart_items'][1]['product_id'])
         self.assertEqual(order_items[1].item_id, data['cart_items'][0]['product_id'])
 
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_redis_round_trips(self, mock_stripe):
+        round_trips = []
+
+        for cart_size in (1, 10):
+            mock_stripe.return_value = {'client_secret': '123', 'id': f'pi_{cart_size}', 'payment_method': 'card'}
+            before = http_request_redis_round_trips.collect().get(('/api/checkout/place-order/',), [None, 0, 0])[1]
+            data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': product_id, 'product_quantity': 1} for product_id in range(1, cart_size + 1)]}
+
+            response = self.client.post('/api/checkout/place-order/', data, format='json')
+            self.assertEqual(response.status_code, 200)
+            release_stock(f'pi_{cart_size}')
+
+            round_trips.append(http_request_redis_round_trips.collect()[('/api/checkout/place-order/',)][1] - before)
+
+        # the catalog version is checked once per request, not once per line
+        self.assertEqual(round_trips[0], round_trips[1])
+
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_duplicate_items(self, mock_stripe):
+        url = f'/api/checkout/place-order/'
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 1, 'product_quantity': 1}, {'product_id': 1, 'product_quantity': 2}]}
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['msg_item_2'], {'item_id': ['Product with id 1 is already in the cart.']})
+
+        mock_stripe.assert_not_called()
+        self.assertEqual(Order.objects.count(), 0)
+
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_invalid_quantity(self, mock_stripe):
+        url = f'/api/checkout/place-order/'
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 4, 'product_quantity': 3}, {'product_id': 5, 'product_quantity': -1}]}
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['cart_items'][1], {'product_quantity': ['Ensure this value is greater than or equal to 1.']})
+
+        mock_stripe.assert_not_called()
+        self.assertEqual(Order.objects.count(), 0)
+
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_out_of_stock(self, mock_stripe):
+        mock_stripe.return_value = {
+            'client_secret': '123',
+            'id': '321',
+            'payment_method': 'card'
+        }
+
+        url = f'/api/checkout/place-order/'
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 1, 'product_quantity': 4}]}
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        # only one left while the first order is unpaid
+        data['cart_items'] = [{'product_id': 1, 'product_quantity': 2}]
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['cart_items'], "Product with id 1 doesn't have enough stock left.")
+
+        mock_stripe.assert_called_once()
+        self.assertEqual(Order.objects.count(), 1)
+
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_payment_intent_failures(self, mock_stripe):
+        url = f'/api/checkout/place-order/'
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 1, 'product_quantity': 4}]}
+
+        mock_stripe.side_effect = stripe.error.RateLimitError('Too many requests')
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 503)
+
+        mock_stripe.side_effect = RuntimeError('unexpected')
+
+        with self.assertRaises(RuntimeError):
+            self.client.post(url, data, format='json')
+
+        # neither failure kept the stock held, the retry gets it
+        mock_stripe.side_effect = None
+        mock_stripe.return_value = {'client_secret': '123', 'id': '321', 'payment_method': 'card'}
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.count(), 1)
+
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_idempotency_key(self, mock_stripe):
+        mock_stripe.return_value = {
+            'client_secret': '123',
+            'id': '321',
+            'payment_method': 'card'
+        }
+
+        url = f'/api/checkout/place-order/'
+        headers = {'Idempotency-Key': uuid.uuid4().hex}
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 1, 'product_quantity': 4}, {'product_id': 2, 'product_quantity': 6}]}
+
+        response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+        # the retry doesn't reach Stripe or the DB
+        with self.assertNumQueries(0):
+            retry_response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(retry_response.status_code, 200)
+        self.assertEqual(retry_response.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry_response.json(), response.json())
+
+        mock_stripe.assert_called_once()
+        self.assertEqual(Order.objects.count(), 1)
+
+        data['cart_items'] = [{'product_id': 2, 'product_quantity': 1}]
+
+        response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()['msg'], 'This Idempotency-Key was already used with a different request.')
+
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_idempotency_key_retryable(self, mock_stripe):
+        mock_stripe.return_value = {'client_secret': '123', 'id': '321', 'payment_method': 'card'}
+
+        url = f'/api/checkout/place-order/'
+        headers = {'Idempotency-Key': uuid.uuid4().hex}
+
+        # product 4 has 3 in stock, all of them held by another order
+        response = self.client.post(url, {'order': {'contact_email': 'other@test.com'}, 'cart_items': [{'product_id': 4, 'product_quantity': 3}]}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 4, 'product_quantity': 1}]}
+
+        response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['cart_items'], "Product with id 4 doesn't have enough stock left.")
+
+        # the other order's payment failed, the retry is handled again instead of replayed
+        release_stock('321')
+        mock_stripe.return_value = {'client_secret': '456', 'id': '654', 'payment_method': 'card'}
+
+        response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+        release_stock('654')
+
+    @override_settings(IDEMPOTENCY_WAIT=0.1)
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_idempotency_key_in_progress(self, mock_stripe):
+        url = f'/api/checkout/place-order/'
+        key = uuid.uuid4().hex
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 1, 'product_quantity': 4}]}
+
+        # another worker is still handling the first request
+        rd_instance.set(idempotency_key('place-order', key), json.dumps({'state': 'pending', 'fingerprint': fingerprint_request(data)}), ex=5)
+
+        response = self.client.post(url, data, format='json', headers={'Idempotency-Key': key})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['msg'], 'A request with this Idempotency-Key is still in progress.')
+
+        mock_stripe.assert_not_called()
+
+        rd_instance.delete(idempotency_key('place-order', key))
+
+    @patch('checkout_api.views.OrderItem.objects.bulk_create')
+    @patch('checkout_api.views.create_payment_intent')
+    def test_post_rollback(self, mock_stripe, mock_bulk_create):
+        mock_stripe.return_value = {
+            'client_secret': '123',
+            'id': '321',
+            'payment_method': 'card'
+        }
+        mock_bulk_create.side_effect = DatabaseError('error, bro')
+
+        url = f'/api/checkout/place-order/'
+
+        data = {'order': {'contact_email': 'test@test.com'}, 'cart_items': [{'product_id': 1, 'product_quantity': 4}, {'product_id': 2, 'product_quantity': 6}]}
+
+        with self.assertRaises(DatabaseError):
+            self.client.post(url, data, format='json')
+
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(OrderItem.objects.count(), 0)
+
 class StripeWebhookTestCase(TestCase):
     def setUp(self):
         self.order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='123')
         OrderItem.objects.create(item_id='1', title='Abstract Horizon Painting', price=5500, quantity=4, order=self.order)
         OrderItem.objects.create(item_id='2', title='Minimalist Ceramic Vase', price=3200, quantity=10, order=self.order)
         OrderItem.objects.create(item_id='3', title='Handwoven Cotton Throw',price=4500, quantity=2, order=self.order)
-    @patch('checkout_api.views.sendreciept_task')
     @patch('checkout_api.views.stripe.Event.construct_from')
-    def test_post_successful(self, mock_event, mock_task):
+    def test_post_successful(self, mock_event):
         url = f'/api/checkout/webhook/'
 
         # mocking payment
         data = SimpleNamespace(object={'id': self.order.payment_intent_id})
-        event_obj = SimpleNamespace(type='payment_intent.succeeded', data=data)
+        event_obj = SimpleNamespace(id=f'evt_{uuid.uuid4().hex}', type='payment_intent.succeeded', data=data)
 
         mock_event.return_value = event_obj
 
@@ -101,25 +342,32 @@ class StripeWebhookTestCase(TestCase):
             'test': 123
         }
 
-        # Test payment_intent.payment_failed
-        response = self.client.post(url, data=data, format='json')
+        hold_id = reserve_stock([{'product_id': 1, 'product_quantity': 4}])
+        rename_hold(hold_id, self.order.payment_intent_id)
+
+        # Test payment_intent.succeeded
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data=json.dumps(data), content_type='application/json')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['msg'], 'Order paid successfully!')  
 
+        # the held units are sold
+        self.assertEqual(Product.objects.get(pk=1).stock, 1)
+        self.assertFalse(release_stock(self.order.payment_intent_id))
+
         modified_order = Order.objects.get(pk=self.order.pk)
 
         self.assertEqual(modified_order.status, Order.PAID)
 
-        mock_task.delay.assert_called_once_with(modified_order.pk)
+        self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')), [(SENDRECIEPT_TASK, [modified_order.pk])])
 
-    @patch('checkout_api.views.sendreciept_task')
     @patch('checkout_api.views.stripe.Event.construct_from')
-    def test_post_failures(self, mock_event, mock_task):
+    def test_post_failures(self, mock_event):
         url = f'/api/checkout/webhook/'
 
         # mocking payment
         data = SimpleNamespace(object={'id': self.order.payment_intent_id})
-        event_obj = SimpleNamespace(type='payment_intent.payment_failed', data=data)
+        event_obj = SimpleNamespace(id=f'evt_{uuid.uuid4().hex}', type='payment_intent.payment_failed', data=data)
 
         mock_event.return_value = event_obj
 
@@ -127,31 +375,129 @@ class StripeWebhookTestCase(TestCase):
             'test': 123
         }
 
+        # the order's stock is held until the payment resolves
+        hold_id = reserve_stock([{'product_id': 1, 'product_quantity': 4}])
+        rename_hold(hold_id, self.order.payment_intent_id)
+
         # Test payment_intent.payment_failed
-        response = self.client.post(url, data=data, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data=json.dumps(data), content_type='application/json')
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json()['msg'], 'Order failed and cancelled!')  
 
+        # and given back once it fails
+        self.assertFalse(release_stock(self.order.payment_intent_id))
+
 
         modified_order = Order.objects.get(pk=self.order.pk)
         
-        mock_task.delay.assert_called_once_with(modified_order.pk)
+        self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')), [(SENDRECIEPT_TASK, [modified_order.pk])])
 
         self.assertEqual(modified_order.status, Order.CANCELLED)
 
-        event_obj = SimpleNamespace(type='payment_intent.payment_something', data=data)
+        event_obj = SimpleNamespace(id=f'evt_{uuid.uuid4().hex}', type='payment_intent.payment_something', data=data)
 
         mock_event.return_value = event_obj
         
         # Test payment_intent.payment_something
-        response = self.client.post(url, data=data, format='json')
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json()['msg'], f'Unhandled event type {event_obj.type}')
 
         mock_event.side_effect = ValueError("error, bro")
 
         # Test 'validate payment made'
-        response = self.client.post(url, data=data, format='json')
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json()['msg'], 'Error loading the payment event!')
 
+
+class StripeWebhookDuplicateTestCase(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='123')
+
+    def test_post(self):
+        url = f'/api/checkout/webhook/'
+
+        event_id = f'evt_{uuid.uuid4().hex}'
+        payload = json.dumps({'id': event_id, 'object': 'event', 'type': 'payment_intent.succeeded', 'data': {'object': {'id': self.order.payment_intent_id}}})
+
+        response = self.client.post(url, data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['msg'], 'Order paid successfully!')
+
+        stored_event = WebhookEvent.objects.get(event_id=event_id)
+        self.assertEqual(stored_event.event_type, 'payment_intent.succeeded')
+        self.assertEqual(stored_event.payload, payload)
+        self.assertTrue(stored_event.processed_at)
+
+        # the redelivery is answered from Redis
+        with self.assertNumQueries(0):
+            response = self.client.post(url, data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['msg'], 'Event already processed!')
+
+        self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')), [(SENDRECIEPT_TASK, [self.order.pk])])
+
+        # and from the event table once Redis forgot about it
+        rd_instance.delete(event_key(event_id))
+
+        response = self.client.post(url, data=payload, content_type='application/json')
+        self.assertEqual(response.json()['msg'], 'Event already processed!')
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+        rd_instance.delete(event_key(event_id))
+
+    def test_post_without_redis(self):
+        url = f'/api/checkout/webhook/'
+
+        event_id = f'evt_{uuid.uuid4().hex}'
+        payload = json.dumps({'id': event_id, 'object': 'event', 'type': 'payment_intent.succeeded', 'data': {'object': {'id': self.order.payment_intent_id}}})
+
+        response = self.client.post(url, data=payload, content_type='application/json')
+        self.assertEqual(response.json()['msg'], 'Order paid successfully!')
+        rd_instance.delete(event_key(event_id))
+
+        # the event table de-duplicates redeliveries on its own while Redis is down
+        with patch('checkout_api.event_store.rd_instance.execute_command', side_effect=redis.exceptions.ConnectionError()), \
+                patch('checkout_api.event_store.rd_instance.pipeline', side_effect=redis.exceptions.ConnectionError()):
+            response = self.client.post(url, data=payload, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['msg'], 'Event already processed!')
+
+            self.assertEqual(process_webhook_events_service([(event_id, 'payment_intent.succeeded', self.order.payment_intent_id, payload)]), [])
+
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+@override_settings(STRIPE_WEBHOOK_MODE='stream')
+class StripeWebhookStreamTestCase(TestCase):
+    def setUp(self):
+        rd_instance.delete(stream_key())
+        self.order = Order.objects.create(contact_email='test@test.com', total=2500, payment_intent_id='123')
+
+    def tearDown(self):
+        rd_instance.delete(stream_key())
+
+    def test_post(self):
+        url = f'/api/checkout/webhook/'
+
+        payload = json.dumps({'id': f'evt_{uuid.uuid4().hex}', 'type': 'payment_intent.succeeded', 'data': {'object': {'id': self.order.payment_intent_id}}})
+
+        # acknowledged without touching the DB
+        with self.assertNumQueries(0):
+            response = self.client.post(url, data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['msg'], 'Event received!')
+
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PENDING)
+
+        payload = json.dumps({'id': f'evt_{uuid.uuid4().hex}', 'type': 'payment_intent.succeeded', 'data': {'object': {'id': 'unknown'}}})
+        self.client.post(url, data=payload, content_type='application/json')
+
+        self.assertEqual(consume_webhook_events_task(), 2)
+
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAID)
+        self.assertEqual(list(OutboxMessage.objects.values_list('task', 'args')), [(SENDRECIEPTS_TASK, [[self.order.pk]])])
+
+        # everything was acknowledged
+        self.assertEqual(consume_webhook_events_task(), 0)
@@ -1,23 +1,27 @@
 from rest_framework import status, generics
 from rest_framework.response import Response
-from checkout_api.serializers import OrderItemSerializer, ProductSerializer, StripeWebhookSerializer, PlaceOrderSerializer, demo_products
-from checkout_api.models import Order
+from checkout_api.serializers import ProductSerializer, StripeWebhookSerializer, PlaceOrderSerializer
+from checkout_api.catalog import get_catalog, get_rendered_products, resolve_cart
+from checkout_api.models import Order, OrderItem
+from checkout_api.reservations import reserve_stock, rename_hold, release_stock
+from checkout_api.services import process_webhook_event_service, build_reciept, WEBHOOK_EVENT_STATUSES
+from checkout_api.event_stream import append_webhook_event
+from checkout_api.idempotency import run_idempotent, retryable
+from checkout_api.stripe_gateway import create_payment_intent, construct_event, verify_signature, stripe_api_key, stripe_webhook_secret
 import redis
 import stripe
 import os
 import json
 from django.conf import settings
+from django.db import transaction, DatabaseError
 import logging
-from checkout_api.tasks import sendreciept_task
 from django.views.generic import TemplateView
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
 
 logger = logging.getLogger(__name__)
-rd_instance = redis.Redis.from_url(settings.CELERY_BROKER_URL, decode_responses=True)
 
-stripe_api_key = os.environ.get('STRIPE_SECRET_KEY') or ''
-stripe.api_key = stripe_api_key
-stripe_webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET') or ''
-stripe_client = stripe.StripeClient(stripe_api_key)
 
 class ClientHomeView(TemplateView):
     template_name = 'index.html'
@@ -34,51 +38,121 @@ class ProductListView(generics.ListAPIView):
     serializer_class = ProductSerializer
 
     def list(self, request):
-        return Response(demo_products, status=status.HTTP_200_OK)
+        # the catalog is rendered once per version, so this never touches the serializer or renderer
+        rendered = get_rendered_products()
+        accepts_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        etag = rendered['gzip_etag'] if accepts_gzip else rendered['etag']
+
+        if_none_match = [tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))]
+
+        if '*' in if_none_match or etag in if_none_match:
+            response = HttpResponseNotModified()
+        elif accepts_gzip:
+            response = HttpResponse(rendered['gzip_body'], content_type='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(rendered['body'], content_type='application/json')
+
+        response.headers['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=settings.PRODUCT_LIST_MAX_AGE)
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        return response
 
 class PlaceOrderView(generics.CreateAPIView):
     serializer_class = PlaceOrderSerializer
 
     def create(self, request):
+        idempotency_key = request.headers.get('Idempotency-Key')
+
+        if not idempotency_key:
+            return self.place_order(request)
+
+        # retries with the same key get the first response instead of a new order and PaymentIntent
+        return run_idempotent('place-order', idempotency_key, request.data, lambda: self.place_order(request))
+
+    def place_order(self, request):
         body = request.data
 
+        # one catalog for the whole request, validating, pricing and reserving each line doesn't check the version again
+        catalog = get_catalog()
+
         # validate input
-        placed_order = PlaceOrderSerializer(data=body)
+        placed_order = PlaceOrderSerializer(data=body, context={'catalog': catalog})
 
         if not placed_order.is_valid():
             return Response(placed_order.errors, status=status.HTTP_400_BAD_REQUEST)
         
         # prepare for payment intent
-        totals = calculate_totals(placed_order.validated_data['cart_items'])
+        totals = calculate_totals(placed_order.validated_data['cart_items'], catalog)
 
         if isinstance(totals, dict):
             totals_err = totals
             return Response(totals_err, status=status.HTTP_400_BAD_REQUEST)
+
+        # Convert cart items into order items before anything gets written
+        order_items = build_orderitems_from_cart(placed_order.validated_data['cart_items'])
+
+        if isinstance(order_items, dict):
+            orderitems_err = order_items
+            return Response(orderitems_err, status=status.HTTP_400_BAD_REQUEST)
+
+        # Hold the stock until the payment goes through
+        try:
+            hold_id = reserve_stock(placed_order.validated_data['cart_items'], catalog)
+        except redis.exceptions.RedisError:
+            logger.exception('Could not reserve stock.')
+            return Response({'msg': 'Stock reservations are unavailable, please try again.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        # the stock may be free again by the next try, don't replay this answer to it
+        if isinstance(hold_id, dict):
+            stock_err = hold_id
+            return retryable(Response(stock_err, status=status.HTTP_400_BAD_REQUEST))
         
         try:    
-            intent = stripe.PaymentIntent.create(
+            intent = create_payment_intent(
                 amount=totals,
                 currency='usd',
                 automatic_payment_methods={
                     'enabled': True,
                 },
             )
-        except stripe.error.AuthenticationError as e:
+        except stripe.error.AuthenticationError:
+            release_stock(hold_id)
             return Response({'stripe': 'API Key not provided'}, status=status.HTTP_400_BAD_REQUEST)
         except stripe.error.InvalidRequestError as e:
+            release_stock(hold_id)
             body = e.json_body
 
             return Response({'stripe': body['error']['message']}, status=status.HTTP_400_BAD_REQUEST)
+        except stripe.error.APIConnectionError:
+            release_stock(hold_id)
+            return Response({'stripe': 'Payment provider is unreachable, please try again.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except stripe.error.StripeError:
+            release_stock(hold_id)
+            logger.exception('Could not create a PaymentIntent.')
+            return Response({'stripe': 'Payment provider is unavailable, please try again.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception:
+            # no order will ever point at this hold, don't leave the stock locked until it expires
+            release_stock(hold_id)
+            raise
         
-        # Create order in DB
-        order = Order.objects.create(contact_email=placed_order.validated_data['order']['contact_email'], total=totals, payment_intent_id=intent['id'])
+        # Create order and all of its items in DB, in one transaction
+        try:
+            with transaction.atomic():
+                contact_email = placed_order.validated_data['order']['contact_email']
+                order = Order.objects.create(contact_email=contact_email, total=totals, payment_intent_id=intent['id'], reciept=build_reciept(contact_email, order_items))
 
-        # Convert cart items into order items for DB
-        order_items = create_orderitems_from_cart(order, placed_order.validated_data['cart_items'])
+                for order_item in order_items:
+                    order_item.order = order
 
-        if isinstance(order_items, dict):
-            orderitems_err = order_items
-            return Response(orderitems_err, status=status.HTTP_400_BAD_REQUEST)
+                OrderItem.objects.bulk_create(order_items)
+        except DatabaseError:
+            release_stock(hold_id)
+            raise
+
+        # the webhook finds the hold by its payment intent
+        rename_hold(hold_id, intent['id'])
 
         return Response({'clientSecret': intent['client_secret'], 'totals': totals, 'msg': "Order drafted! Now complete the payment to confirm it.", 'status': status.HTTP_200_OK})
     
@@ -90,6 +164,9 @@ class StripeWebhookView(generics.CreateAPIView):
         payload = request.body
         event = None
 
+        if settings.STRIPE_WEBHOOK_MODE == 'stream':
+            return self.enqueue_event(request, payload)
+
         # validate payment made
         try:
             event = stripe.Event.construct_from(
@@ -101,74 +178,73 @@ class StripeWebhookView(generics.CreateAPIView):
         if stripe_webhook_secret:
             sig_header = request.headers.get('stripe-signature')
             try:
-                event = stripe_client.construct_event(
-                    payload, sig_header, stripe_webhook_secret
-                )
+                event = construct_event(payload, sig_header)
             except stripe.error.SignatureVerificationError as e:
                 print('⚠️  Webhook signature verification failed.' + str(e))
                 return Response({'success': False}, status=status.HTTP_401_UNAUTHORIZED)
 
         # validate payment status
-        if event.type == 'payment_intent.succeeded':
-            payment_intent = event.data.object
-
-            order = Order.objects.get(payment_intent_id=payment_intent['id'])
+        if event.type not in WEBHOOK_EVENT_STATUSES:
+            return Response({'msg': f'Unhandled event type {event.type}'}, status=status.HTTP_400_BAD_REQUEST)
 
-            order.status = Order.PAID
+        payment_intent = event.data.object
 
-            order.save()
+        # Stripe delivers at least once, repeats of a processed event stop here
+        # the receipt goes out through the outbox, written in the same transaction as the status
+        is_new, _ = process_webhook_event_service(event.id, event.type, payment_intent['id'], payload)
 
-            sendreciept_task.delay(order.pk)
+        if not is_new:
+            return Response({'msg': 'Event already processed!', 'status': status.HTTP_200_OK})
 
+        if event.type == 'payment_intent.succeeded':
             return Response({'msg': "Order paid successfully!", 'status': status.HTTP_200_OK})
-        elif event.type == 'payment_intent.payment_failed':
-            payment_intent = event.data.object
+        else:
+            return Response({'msg': 'Order failed and cancelled!'}, status=status.
+            HTTP_400_BAD_REQUEST) 
 
-            order = Order.objects.get(payment_intent_id=payment_intent['id'])
+    def enqueue_event(self, request, payload):
+        # acknowledge right away, consume_webhook_events_task applies the event in the background
+        if stripe_webhook_secret:
+            sig_header = request.headers.get('stripe-signature')
+            try:
+                verify_signature(payload, sig_header)
+            except stripe.error.SignatureVerificationError as e:
+                logger.warning('Webhook signature verification failed. %s', e)
+                return Response({'success': False}, status=status.HTTP_401_UNAUTHORIZED)
 
-            order.status = Order.CANCELLED
+        append_webhook_event(payload)
 
-            order.save()
+        return Response({'msg': 'Event received!', 'status': status.HTTP_200_OK})
 
-            sendreciept_task.delay(order.pk)
-            
-            return Response({'msg': 'Order failed and cancelled!'}, status=status.
-            HTTP_400_BAD_REQUEST) 
-        else:
-            return Response({'msg': f'Unhandled event type {event.type}'}, status=status.HTTP_400_BAD_REQUEST)
-
-def calculate_totals(cart_items):
+def calculate_totals(cart_items, catalog=None):
     totals = 0
 
-    for index, cart_item in enumerate(cart_items):
-        validated_data = cart_item
-
-        matched_product = next((product for product in demo_products if product.get('id') == validated_data['product_id']), None)
-        
-        totals += matched_product['price_cents'] * validated_data['product_quantity']
+    for cart_item, matched_product in resolve_cart(cart_items, catalog):
+        totals += matched_product['price_cents'] * cart_item['product_quantity']
 
     if totals < 50:
         return {'cart_items': 'Cart cannot be empty!'}
     
     return totals
 
-def create_orderitems_from_cart(order, cart_items):
+def build_orderitems_from_cart(cart_items):
+    order_items = []
+    item_ids = set()
+
     for index, cart_item in enumerate(cart_items):
         validated_data = cart_item
 
-        data = {
-            'item_id': validated_data['product_id'],
-            'quantity': validated_data['product_quantity'],
-            'price': validated_data['product_price'],
-            'title': validated_data['product_title'],
-            'order': order.pk
-        }
+        # mirrors the unique_order_item constraint so bulk_create can't fail halfway
+        if validated_data['product_id'] in item_ids:
+            return {f'msg_item_{index + 1}': {'item_id': [f"Product with id {validated_data['product_id']} is already in the cart."]}}
 
-        order_item = OrderItemSerializer(data=data)
+        item_ids.add(validated_data['product_id'])
 
-        if not order_item.is_valid():
-            return {f'msg_item_{index + 1}': order_item.errors}
-        
-        order_item.save()
+        order_items.append(OrderItem(
+            item_id=validated_data['product_id'],
+            quantity=validated_data['product_quantity'],
+            price=validated_data['product_price'],
+            title=validated_data['product_title']
+        ))
     
-    return None
+    return order_items
@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from kombu import Queue
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'commerceproject.settings')
@@ -13,6 +14,45 @@ app = Celery('commerceproject')
 #   should have a `CELERY_` prefix.
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# Receipts a customer is waiting for go through "transactional", mail posted to /api/mail/
+# through "bulk", and everything else through the default "celery" queue. Each kind of worker
+# picks its queues, concurrency and prefetch on the command line, see compose.yaml.
+TRANSACTIONAL_QUEUE = 'transactional'
+DEFAULT_QUEUE = 'celery'
+BULK_QUEUE = 'bulk'
+
+app.conf.task_queues = (
+    Queue(TRANSACTIONAL_QUEUE, routing_key=TRANSACTIONAL_QUEUE),
+    Queue(DEFAULT_QUEUE, routing_key=DEFAULT_QUEUE),
+    Queue(BULK_QUEUE, routing_key=BULK_QUEUE),
+)
+app.conf.task_default_queue = DEFAULT_QUEUE
+
+# Execution profiles, passed to @shared_task. Nothing reads what a task returns, so none of them
+# store it; chunks of mail are large and repetitive, so they're compressed on the way through the broker
+FIRE_AND_FORGET = {'ignore_result': True}
+BULK_PAYLOAD = {'ignore_result': True, 'compression': 'zlib'}
+
+app.conf.task_routes = {
+    'checkout_api.tasks.sendreciept_task': {'queue': TRANSACTIONAL_QUEUE, 'priority': 0},
+    'checkout_api.tasks.sendreciepts_task': {'queue': TRANSACTIONAL_QUEUE, 'priority': 3},
+    'checkout_api.tasks.consume_webhook_events_task': {'queue': TRANSACTIONAL_QUEUE, 'priority': 3},
+    'checkout_api.tasks.relay_outbox_task': {'queue': TRANSACTIONAL_QUEUE, 'priority': 0},
+    'mail_dispatch_api.tasks.sendmail_task': {'queue': BULK_QUEUE},
+    'mail_dispatch_api.tasks.sendmail_batch_task': {'queue': BULK_QUEUE},
+}
+
+app.conf.broker_transport_options = {
+    # a worker consuming several queues always drains them in the order given to -Q,
+    # so bulk mail only gets a slot once the transactional queue is empty
+    'queue_order_strategy': 'priority',
+    # lower is more urgent within a queue
+    'priority_steps': [0, 3, 6, 9],
+}
+
+# task latency, query and Redis metrics, through Celery's task signals
+app.conf.imports = ('commerceproject.instrumentation',)
+
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
 
@@ -0,0 +1,59 @@
+import os
+import time
+from django.db.backends.postgresql import base
+from commerceproject import metrics
+
+connect_seconds = metrics.histogram('db_connect_seconds', 'Time spent opening database connections, what a request or task waits when it has none to reuse.', ('alias',))
+connections_opened = metrics.counter('db_connections_opened_total', 'Database connections opened.', ('alias',))
+connections_open = metrics.gauge('db_connections_open', 'Database connections open in this process.', ('alias',))
+health_check_failures = metrics.counter('db_connection_health_check_failures_total', 'Reused database connections found broken and replaced.', ('alias',))
+query_seconds = metrics.histogram('db_query_duration_seconds', 'Latency of database queries.', ('alias',))
+
+def record_query(alias):
+    def execute(execute, sql, params, many, context):
+        started = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            query_seconds.observe(elapsed, alias=alias)
+            usage = metrics.current_usage.get()
+
+            if usage is not None:
+                usage.db_queries += 1
+                usage.db_seconds += elapsed
+
+    return execute
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened_in = None
+        # every query of every cursor is timed, and counted towards the request or task running it
+        self.execute_wrappers.append(record_query(self.alias))
+
+    def get_new_connection(self, conn_params):
+        with connect_seconds.time(alias=self.alias):
+            connection = super().get_new_connection(conn_params)
+
+        connections_opened.inc(alias=self.alias)
+        connections_open.inc(alias=self.alias)
+        self.opened_in = os.getpid()
+
+        return connection
+
+    def _close(self):
+        # a connection a forked child inherited was counted by the parent
+        if self.connection is not None and self.opened_in == os.getpid():
+            connections_open.dec(alias=self.alias)
+
+        return super()._close()
+
+    def is_usable(self):
+        usable = super().is_usable()
+
+        if not usable:
+            health_check_failures.inc(alias=self.alias)
+
+        return usable
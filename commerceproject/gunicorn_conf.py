@@ -0,0 +1,60 @@
+import os
+import math
+
+# Serving configuration for gunicorn:
+#   gunicorn -c python:commerceproject.gunicorn_conf commerceproject.wsgi
+# GUNICORN_WORKER_CLASS=asgi serves commerceproject.asgi instead, for long-lived streaming responses.
+#
+# With preload_app the code is loaded once by the master, so `kill -HUP` only restarts workers on
+# the same code. To deploy new code without dropping requests, send USR2 (a new master starts next
+# to the old one), then WINCH and TERM to the old master once the new workers answer.
+
+def available_cores():
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+    # a container's CPU quota is lower than the cores it can see
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+
+        if quota != 'max':
+            cores = min(cores, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+
+    return cores
+
+cores = available_cores()
+
+bind = f"{os.environ.get('HOST') or '0.0.0.0'}:{os.environ.get('PORT') or 8000}"
+
+# "gthread" for the WSGI app, "asgi" for the ASGI one
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS') or cores * 2 + 1)
+# requests mostly wait on Postgres, Redis and Stripe, threads overlap that waiting within a worker
+threads = int(os.environ.get('GUNICORN_THREADS') or (1 if worker_class == 'asgi' else 4))
+# open connections an asgi worker juggles at once
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or 1000)
+# Django doesn't speak the ASGI lifespan protocol
+asgi_lifespan = 'off'
+
+# workers share the imported app copy-on-write, and a broken import fails at startup instead of per worker
+# GUNICORN_RELOAD restarts workers on code changes for local development, which needs the app loaded per worker
+reload = (os.environ.get('GUNICORN_RELOAD') or 'false').lower() == 'true'
+preload_app = not reload
+
+# workers are replaced after this many requests, at staggered times so they never all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 1000)
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER') or max_requests // 10)
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)
+# requests in flight get this long to finish on TERM or when a worker is replaced
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE') or 5)
+
+# the worker heartbeat file lives in memory, a slow disk would get workers killed as stuck
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
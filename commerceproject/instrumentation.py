@@ -0,0 +1,68 @@
+import time
+from celery.signals import task_prerun, task_postrun
+from commerceproject import metrics
+from commerceproject.metrics_store import metrics_store
+
+# Where the time of each request and task goes. The database backend, the Redis client and the
+# Stripe gateway add what they spend to the Usage of the request or task they run in.
+
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+http_request_seconds = metrics.histogram('http_request_duration_seconds', 'Latency of HTTP requests.', ('route', 'method', 'status'))
+http_request_db_queries = metrics.histogram('http_request_db_queries', 'Database queries per HTTP request.', ('route',), COUNT_BUCKETS)
+http_request_db_seconds = metrics.histogram('http_request_db_duration_seconds', 'Time per HTTP request spent in database queries.', ('route',))
+http_request_redis_round_trips = metrics.histogram('http_request_redis_round_trips', 'Redis round trips per HTTP request.', ('route',), COUNT_BUCKETS)
+http_request_stripe_seconds = metrics.histogram('http_request_stripe_duration_seconds', 'Time per HTTP request spent waiting on Stripe.', ('route',))
+
+task_seconds = metrics.histogram('celery_task_duration_seconds', 'Run time of Celery tasks.', ('task', 'state'))
+task_db_queries = metrics.histogram('celery_task_db_queries', 'Database queries per Celery task.', ('task',), COUNT_BUCKETS)
+task_db_seconds = metrics.histogram('celery_task_db_duration_seconds', 'Time per Celery task spent in database queries.', ('task',))
+task_redis_round_trips = metrics.histogram('celery_task_redis_round_trips', 'Redis round trips per Celery task, the broker excluded.', ('task',), COUNT_BUCKETS)
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics_store.ensure_running()
+        usage = metrics.Usage()
+        token = metrics.current_usage.set(usage)
+        started = time.perf_counter()
+
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_usage.reset(token)
+
+        # the URL pattern, not the path, keeps the label values few
+        route = '/' + request.resolver_match.route if request.resolver_match else 'unmatched'
+
+        http_request_seconds.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+        http_request_db_queries.observe(usage.db_queries, route=route)
+        http_request_db_seconds.observe(usage.db_seconds, route=route)
+        http_request_redis_round_trips.observe(usage.redis_round_trips, route=route)
+        http_request_stripe_seconds.observe(usage.stripe_seconds, route=route)
+
+        return response
+
+# task id: (context token, usage, started)
+running_tasks = {}
+
+@task_prerun.connect
+def start_task_metrics(task_id=None, task=None, **kwargs):
+    metrics_store.ensure_running()
+    usage = metrics.Usage()
+    running_tasks[task_id] = (metrics.current_usage.set(usage), usage, time.perf_counter())
+
+@task_postrun.connect
+def record_task_metrics(task_id=None, task=None, state=None, **kwargs):
+    if task_id not in running_tasks:
+        return
+
+    token, usage, started = running_tasks.pop(task_id)
+    metrics.current_usage.reset(token)
+
+    task_seconds.observe(time.perf_counter() - started, task=task.name, state=state)
+    task_db_queries.observe(usage.db_queries, task=task.name)
+    task_db_seconds.observe(usage.db_seconds, task=task.name)
+    task_redis_round_trips.observe(usage.redis_round_trips, task=task.name)
@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# In-process metrics shared by the apps. Each worker process keeps its own values, metrics_store
+# adds them up across processes for /metrics.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = {}
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def label_values(self, labels):
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def sample_lines(self, key, value):
+        return [f'{self.name}{format_labels(zip(self.labelnames, key))} {format_value(value)}']
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.label_values(labels), 0)
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.label_values(labels), 0)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+
+        with self.lock:
+            # bucket counts, sum, count
+            entry = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get_count(self, **labels):
+        entry = self.values.get(self.label_values(labels))
+
+        return entry[2] if entry else 0
+
+    def collect(self):
+        with self.lock:
+            return {key: [list(entry[0]), entry[1], entry[2]] for key, entry in self.values.items()}
+
+    def sample_lines(self, key, value):
+        buckets, total, count = value
+        labels = list(zip(self.labelnames, key))
+        lines = [f'{self.name}_bucket{format_labels(labels + [("le", repr(float(bound)))])} {format_value(hits)}' for bound, hits in zip(self.buckets, buckets)]
+        lines.append(f'{self.name}_bucket{format_labels(labels + [("le", "+Inf")])} {format_value(count)}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(total)}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {format_value(count)}')
+
+        return lines
+
+class Usage:
+    # what the request or task being served spent on its backends
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_round_trips = 0
+        self.redis_seconds = 0.0
+        self.stripe_seconds = 0.0
+
+# set by the request middleware and the Celery task signals, None anywhere else
+current_usage = contextvars.ContextVar('current_usage', default=None)
+
+def reset_after_fork():
+    # a forked child counts for itself, what the parent recorded is the parent's to report.
+    # the locks are replaced rather than taken, a thread of the parent may have held one
+    for metric in registry.values():
+        metric.lock = threading.Lock()
+        metric.values = {}
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def register(metric):
+    # modules are imported once per process, but keep re-registration harmless
+    return registry.setdefault(metric.name, metric)
+
+def counter(name, documentation, labelnames=()):
+    return register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=()):
+    return register(Gauge(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, documentation, labelnames, buckets))
+
+def format_value(value):
+    value = float(value)
+
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def format_labels(labels):
+    labels = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+def render(values=None):
+    # Prometheus text format, of the given {name: {label values: value}} or else of this process
+    lines = []
+
+    for name, metric in sorted(registry.items()):
+        documentation = metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {metric.type}')
+
+        for key, value in sorted((metric.collect() if values is None else values.get(name, {})).items()):
+            lines.extend(metric.sample_lines(key, value))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import atexit
+import socket
+import logging
+import threading
+import redis
+from django.conf import settings
+from django.db import connection
+from commerceproject import metrics
+from commerceproject.redis_client import rd_instance
+
+logger = logging.getLogger(__name__)
+
+# Adds up the metrics of every web and worker process in Redis, so /metrics shows the whole deployment
+# whichever process serves it. Counters and histograms are pushed as increments into one hash, so they
+# keep counting after a process exits; gauges are each process's current value, kept while it lives.
+# Those sit in a hash of process -> JSON next to a sorted set of processes scored by when their gauges
+# expire, which every push prunes, so reading them never has to search the keyspace.
+
+# the same pool, without counting these pushes as Redis round trips of the app
+store_client = redis.Redis(connection_pool=rd_instance.connection_pool)
+
+def totals_key():
+    return f"metrics:{connection.settings_dict['NAME']}"
+
+def gauges_key():
+    return f"metrics-gauges:{connection.settings_dict['NAME']}"
+
+def gauges_expiry_key():
+    return f"metrics-gauges-expiry:{connection.settings_dict['NAME']}"
+
+# ARGV: gauges key, gauges expiry key, now
+prune_gauges_script = store_client.register_script("""
+local expired = redis.call('ZRANGEBYSCORE', ARGV[2], '-inf', ARGV[3], 'LIMIT', 0, 100)
+
+if #expired > 0 then
+    redis.call('HDEL', ARGV[1], unpack(expired))
+    redis.call('ZREM', ARGV[2], unpack(expired))
+end
+
+return #expired
+""")
+
+def flatten(metric, value):
+    # (part, number) pairs, a histogram's parts are its bucket indexes, sum and count
+    if metric.type == 'histogram':
+        return list(enumerate(value[0])) + [('sum', value[1]), ('count', value[2])]
+
+    return [(None, value)]
+
+class MetricsStore:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # a forked child pushes what it records itself, from a thread of its own
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pushed = {}
+        self.process = f'{socket.gethostname()}-{os.getpid()}'
+
+    def ensure_running(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.run, name='metrics-push', daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(settings.METRICS_PUSH_INTERVAL)
+
+            try:
+                self.push()
+            except redis.exceptions.RedisError:
+                logger.warning('Metrics could not be pushed to Redis, retrying with the next push.')
+            except Exception:
+                # nothing would push this process's metrics again if the thread died
+                logger.exception('Metrics could not be pushed, retrying with the next push.')
+
+    def push(self):
+        with self.lock:
+            current = {name: (metric, metric.collect()) for name, metric in metrics.registry.items()}
+            pipe = store_client.pipeline(transaction=False)
+            gauges = {}
+
+            for name, (metric, values) in current.items():
+                if metric.type == 'gauge':
+                    gauges[name] = [[key, value] for key, value in values.items()]
+                    continue
+
+                pushed = self.pushed.get(name, {})
+
+                for key, value in values.items():
+                    previous = dict(flatten(metric, pushed[key])) if key in pushed else {}
+
+                    for part, number in flatten(metric, value):
+                        # a value lower than the last push was reset, all of it is new
+                        delta = number - previous.get(part, 0) if number >= previous.get(part, 0) else number
+
+                        if delta:
+                            pipe.hincrbyfloat(totals_key(), json.dumps([name, key, part]), delta)
+
+            # a process that stops pushing drops out after missing a few pushes
+            ttl = int(settings.METRICS_PUSH_INTERVAL * 3) + 1
+            now = time.time()
+            pipe.hset(gauges_key(), self.process, json.dumps(gauges))
+            pipe.zadd(gauges_expiry_key(), {self.process: now + ttl})
+            prune_gauges_script(args=[gauges_key(), gauges_expiry_key(), now], client=pipe)
+
+            # both go once no process is left to push
+            pipe.expire(gauges_key(), ttl)
+            pipe.expire(gauges_expiry_key(), ttl)
+            pipe.execute()
+
+            # only once Redis has them, a failed push is sent again with the next one
+            self.pushed = {name: values for name, (metric, values) in current.items()}
+
+    def push_at_exit(self):
+        # counters recorded since the last push would be lost with the process
+        if self.pid == os.getpid():
+            try:
+                self.push()
+            except redis.exceptions.RedisError:
+                logger.warning('Metrics recorded since the last push were lost.')
+            except Exception:
+                logger.exception('Metrics recorded since the last push were lost.')
+
+    def collect(self):
+        # {name: {label values: value}} of every process, this one brought up to date first
+        self.push()
+        values = {}
+
+        for field, number in store_client.hgetall(totals_key()).items():
+            name, key, part = json.loads(field)
+            metric = metrics.registry.get(name)
+
+            if metric is None:
+                continue
+
+            if metric.type == 'histogram':
+                entry = values.setdefault(name, {}).setdefault(tuple(key), [[0] * len(metric.buckets), 0, 0])
+
+                if part == 'sum':
+                    entry[1] = float(number)
+                elif part == 'count':
+                    entry[2] = float(number)
+                elif part < len(metric.buckets):
+                    entry[0][part] = float(number)
+            else:
+                values.setdefault(name, {})[tuple(key)] = float(number)
+
+        processes = store_client.zrangebyscore(gauges_expiry_key(), time.time(), '+inf')
+
+        for gauges in filter(None, store_client.hmget(gauges_key(), processes) if processes else []):
+            for name, samples in json.loads(gauges).items():
+                if name in metrics.registry:
+                    for key, value in samples:
+                        values.setdefault(name, {})[tuple(key)] = values.get(name, {}).get(tuple(key), 0) + value
+
+        return values
+
+    def render(self):
+        try:
+            return metrics.render(self.collect())
+        except redis.exceptions.RedisError:
+            logger.warning('Metrics could not be read from Redis, serving this process only.')
+            return metrics.render()
+
+metrics_store = MetricsStore()
+os.register_at_fork(after_in_child=metrics_store.reset)
+atexit.register(metrics_store.push_at_exit)
@@ -0,0 +1,122 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from django.conf import settings
+from kombu.exceptions import OperationalError, LimitExceeded
+from kombu.pools import ProducerPool
+from commerceproject import metrics
+from commerceproject.celery import app
+
+logger = logging.getLogger(__name__)
+
+tasks_buffered = metrics.counter('task_publish_buffered_total', 'Tasks kept in memory because the broker was slow or unreachable.', ('task',))
+tasks_dropped = metrics.counter('task_publish_dropped_total', 'Tasks lost because the publish buffer was full.', ('task',))
+buffer_size = metrics.gauge('task_publish_buffer_size', 'Tasks waiting in memory to be published.')
+
+class TaskProducer:
+    # publishes tasks from request threads without letting a slow broker stall them, a publish that
+    # doesn't finish within TASK_PUBLISH_TIMEOUT goes to a bounded in-memory buffer instead, which a
+    # background thread flushes once the broker answers again
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # a forked child starts empty, the parent's connections, locks and thread don't carry over
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.pool = None
+        self.errors = None
+        self.buffer = deque()
+        self.flusher = None
+        buffer_size.set(0)
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                timeout = settings.TASK_PUBLISH_TIMEOUT
+                # connections of its own, these socket timeouts would break the long polls of a worker's consumer
+                connection = app.connection_for_write(connect_timeout=timeout, transport_options={
+                    'socket_timeout': timeout,
+                    'socket_connect_timeout': timeout,
+                    # one attempt, the buffer does the retrying
+                    'max_retries': 0,
+                })
+                self.errors = (OperationalError, LimitExceeded) + connection.connection_errors + connection.channel_errors
+                self.pool = ProducerPool(connection.Pool(limit=settings.TASK_PUBLISH_POOL_SIZE), limit=settings.TASK_PUBLISH_POOL_SIZE)
+
+            return self.pool
+
+    def publish(self, task, *args, **kwargs):
+        # same arguments as task.delay()
+        message = (task, args, kwargs)
+
+        # while anything is buffered the broker was slow a moment ago, queue up behind it
+        # instead of making this request wait out the timeout too
+        if self.buffer or not self.send(message):
+            self.add_to_buffer(message)
+
+    def send(self, message):
+        task, args, kwargs = message
+        pool = self.get_pool()
+
+        try:
+            with pool.acquire(block=True, timeout=settings.TASK_PUBLISH_TIMEOUT) as producer:
+                task.apply_async(args, kwargs, producer=producer, retry=False)
+        except self.errors as e:
+            logger.warning('Publishing %s failed: %r', task.name, e)
+            return False
+
+        return True
+
+    def add_to_buffer(self, message):
+        task = message[0]
+
+        with self.lock:
+            if len(self.buffer) >= settings.TASK_PUBLISH_BUFFER_SIZE:
+                tasks_dropped.inc(task=task.name)
+                logger.error('Task publish buffer is full, dropped %s.', task.name)
+                return
+
+            self.buffer.append(message)
+            buffer_size.set(len(self.buffer))
+
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, name='task-producer-flush', daemon=True)
+                self.flusher.start()
+
+        tasks_buffered.inc(task=task.name)
+
+    def flush(self):
+        # publishes buffered tasks in order until the buffer is empty or the broker fails again,
+        # returns how many went out
+        sent = 0
+
+        with self.flushing:
+            while self.buffer:
+                if not self.send(self.buffer[0]):
+                    break
+
+                with self.lock:
+                    self.buffer.popleft()
+                    buffer_size.set(len(self.buffer))
+
+                sent += 1
+
+        return sent
+
+    def run_flusher(self):
+        while True:
+            # the broker just failed a publish, give it a moment before the next try
+            time.sleep(settings.TASK_PUBLISH_FLUSH_INTERVAL)
+            self.flush()
+
+task_producer = TaskProducer()
+os.register_at_fork(after_in_child=task_producer.reset)
+# one last try for whatever is still buffered when the process shuts down
+atexit.register(task_producer.flush)
+
+def publish(task, *args, **kwargs):
+    task_producer.publish(task, *args, **kwargs)
@@ -0,0 +1,40 @@
+import time
+import redis
+from django.conf import settings
+from commerceproject import metrics
+
+redis_seconds = metrics.histogram('redis_command_duration_seconds', 'Latency of Redis round trips, a pipeline counts once.', ('command',))
+
+def record_round_trip(command, started):
+    elapsed = time.perf_counter() - started
+    redis_seconds.observe(elapsed, command=command)
+    usage = metrics.current_usage.get()
+
+    if usage is not None:
+        usage.redis_round_trips += 1
+        usage.redis_seconds += elapsed
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            record_round_trip('PIPELINE', started)
+
+class InstrumentedRedis(redis.Redis):
+    # scripts and locks go through execute_command too
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            record_round_trip(str(args[0]).upper(), started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+# one connection pool per process, shared by every app that talks to Redis
+rd_instance = InstrumentedRedis.from_url(settings.CELERY_BROKER_URL, decode_responses=True)
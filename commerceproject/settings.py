@@ -58,6 +58,8 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    # first, so it times everything below it
+    'commerceproject.instrumentation.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,14 +92,26 @@ WSGI_APPLICATION = 'commerceproject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Seconds a connection stays open for the next request or task of the same thread, each web thread and worker
+# process holds at most one. Under the ASGI worker Django can't reuse them safely, so they're closed after every request
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE') or (0 if os.environ.get('GUNICORN_WORKER_CLASS') == 'asgi' else 600))
+# "true" when POSTGRES_HOST is a PgBouncer in transaction pooling mode
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'False').lower() == 'true'
+
 DATABASES = {
     "default": {
         "NAME": os.environ.get('POSTGRES_DB') or 'commerceproject',
-        "ENGINE": "django.db.backends.postgresql",
+        # Django's PostgreSQL backend with connection metrics
+        "ENGINE": "commerceproject.db",
         "USER": os.environ.get('POSTGRES_USER') or 'exampleuser',
         "PASSWORD": os.environ.get('POSTGRES_PASSWORD') or 'testtest',
         "HOST": os.environ.get('POSTGRES_HOST') or "postgres",
-        "PORT": "5432",
+        "PORT": os.environ.get('POSTGRES_PORT') or "5432",
+        "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+        # a reused connection is checked once per request or task, and replaced if the server dropped it
+        "CONN_HEALTH_CHECKS": True,
+        # PgBouncer hands the server connection to someone else when a transaction ends, a cursor can't outlive it
+        "DISABLE_SERVER_SIDE_CURSORS": DB_PGBOUNCER,
         "TEST": {
             "NAME": "commerceproject_test_db"
         }
@@ -148,7 +162,68 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://127.0.0.1:6379/0')
-CELERY_RESULT_BACKEND = os.environ.get('CELERY_BROKER_URL', 'redis://127.0.0.1:6379/0')
+# Task results are only stored when a result backend is set, nothing reads them today
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND') or None
+# Every process adds its metrics to the totals in Redis this often (in seconds), /metrics serves the totals
+METRICS_PUSH_INTERVAL = float(os.environ.get('METRICS_PUSH_INTERVAL') or 10)
+# Web processes publish tasks over a pool of broker connections and give up on the broker after this long (in seconds)
+TASK_PUBLISH_TIMEOUT = float(os.environ.get('TASK_PUBLISH_TIMEOUT') or 0.5)
+TASK_PUBLISH_POOL_SIZE = int(os.environ.get('TASK_PUBLISH_POOL_SIZE') or 10)
+# Tasks that couldn't be published wait in memory, at most this many per process, and are retried every TASK_PUBLISH_FLUSH_INTERVAL seconds
+TASK_PUBLISH_BUFFER_SIZE = int(os.environ.get('TASK_PUBLISH_BUFFER_SIZE') or 10000)
+TASK_PUBLISH_FLUSH_INTERVAL = float(os.environ.get('TASK_PUBLISH_FLUSH_INTERVAL') or 1)
+
+# Product catalog read-through cache (in seconds)
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL') or 3600)
+# How long clients may reuse the product list before revalidating it with its ETag (in seconds)
+PRODUCT_LIST_MAX_AGE = int(os.environ.get('PRODUCT_LIST_MAX_AGE') or 30)
+
+# How long placed orders hold their stock while waiting for the payment (in seconds)
+STOCK_HOLD_TTL = int(os.environ.get('STOCK_HOLD_TTL') or 900)
+
+# Place-order responses are kept for retries with the same Idempotency-Key (in seconds)
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL') or 86400)
+# How long a request in flight keeps its key locked, and how long duplicates wait for it
+IDEMPOTENCY_LOCK_TTL = int(os.environ.get('IDEMPOTENCY_LOCK_TTL') or 60)
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT') or 10)
+
+# Stripe API calls (timeouts in seconds)
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT') or 3)
+STRIPE_READ_TIMEOUT = float(os.environ.get('STRIPE_READ_TIMEOUT') or 15)
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES') or 2)
+# Keep-alive connections per worker process, one per thread is enough
+STRIPE_POOL_SIZE = int(os.environ.get('STRIPE_POOL_SIZE') or 10)
+
+# "inline" applies Stripe webhooks in the request, "stream" only verifies and queues them in Redis
+STRIPE_WEBHOOK_MODE = os.environ.get('STRIPE_WEBHOOK_MODE') or 'inline'
+STRIPE_EVENT_STREAM_MAXLEN = int(os.environ.get('STRIPE_EVENT_STREAM_MAXLEN') or 100000)
+STRIPE_EVENT_BATCH_SIZE = int(os.environ.get('STRIPE_EVENT_BATCH_SIZE') or 100)
+# Queued events a consumer took but never acknowledged are taken over after this long (in milliseconds)
+STRIPE_EVENT_CLAIM_IDLE_MS = int(os.environ.get('STRIPE_EVENT_CLAIM_IDLE_MS') or 60000)
+# Processed Stripe event ids are remembered in Redis this long (in seconds), the event table keeps them for good
+STRIPE_EVENT_DEDUPE_TTL = int(os.environ.get('STRIPE_EVENT_DEDUPE_TTL') or 259200)
+STRIPE_EVENT_LOCK_TTL = int(os.environ.get('STRIPE_EVENT_LOCK_TTL') or 60)
+# Receipts of a batch of webhook events are sent this many per task
+RECEIPT_CHUNK_SIZE = int(os.environ.get('RECEIPT_CHUNK_SIZE') or 50)
+# Outbox messages are published this many per transaction
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE') or 500)
+
+CELERY_BEAT_SCHEDULE = {
+    'release-expired-holds': {
+        'task': 'checkout_api.tasks.release_expired_holds_task',
+        'schedule': 60.0,
+    },
+    'relay-outbox': {
+        'task': 'checkout_api.tasks.relay_outbox_task',
+        'schedule': 1.0,
+    },
+}
+
+if STRIPE_WEBHOOK_MODE == 'stream':
+    CELERY_BEAT_SCHEDULE['consume-webhook-events'] = {
+        'task': 'checkout_api.tasks.consume_webhook_events_task',
+        'schedule': 1.0,
+    }
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = os.environ.get('EMAIL_HOST') or '127.0.0.1'
@@ -157,9 +232,35 @@ EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
 EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'False').lower() == 'true'
 EMAIL_USE_SSL = os.environ.get('EMAIL_USE_SSL', 'False').lower() == 'true'
+EMAIL_TIMEOUT = int(os.environ.get('EMAIL_TIMEOUT') or 10)
+# Mail workers keep their SMTP connection open, and replace it after this many messages or seconds
+EMAIL_CONNECTION_MAX_MESSAGES = int(os.environ.get('EMAIL_CONNECTION_MAX_MESSAGES') or 100)
+EMAIL_CONNECTION_MAX_AGE = int(os.environ.get('EMAIL_CONNECTION_MAX_AGE') or 300)
+# "smtp" sends through one pooled connection per worker process, "async" runs up to MAIL_ASYNC_CONCURRENCY
+# SMTP sessions at once from each process (at most MAIL_ASYNC_PER_DOMAIN per recipient domain), bypassing EMAIL_BACKEND
+MAIL_SENDER = os.environ.get('MAIL_SENDER') or 'smtp'
+MAIL_ASYNC_CONCURRENCY = int(os.environ.get('MAIL_ASYNC_CONCURRENCY') or 50)
+MAIL_ASYNC_PER_DOMAIN = int(os.environ.get('MAIL_ASYNC_PER_DOMAIN') or 10)
+# Batches posted to /api/mail/ are capped at MAIL_BATCH_MAX_SIZE emails, and sent MAIL_CHUNK_SIZE per task and SMTP session
+MAIL_BATCH_MAX_SIZE = int(os.environ.get('MAIL_BATCH_MAX_SIZE') or 10000)
+MAIL_CHUNK_SIZE = int(os.environ.get('MAIL_CHUNK_SIZE') or 100)
+# Mail bodies of at least this many bytes wait in Redis for MAIL_BODY_TTL seconds, and tasks only carry their key
+MAIL_BODY_REF_MIN_SIZE = int(os.environ.get('MAIL_BODY_REF_MIN_SIZE') or 1024)
+MAIL_BODY_TTL = int(os.environ.get('MAIL_BODY_TTL') or 86400)
+# Sends per second allowed towards the SMTP relay, shared by all mail workers (0 turns the limit off), and the burst allowed on top
+MAIL_RATE_LIMIT = float(os.environ.get('MAIL_RATE_LIMIT') or 0)
+MAIL_RATE_BURST = int(os.environ.get('MAIL_RATE_BURST') or 20)
+# Per relay host overrides, as "host=rate:burst,host=rate:burst"
+MAIL_RATE_LIMITS = {}
+for relay_limit in filter(None, (os.environ.get('MAIL_RATE_LIMITS') or '').split(',')):
+    relay_host, _, relay_rate = relay_limit.partition('=')
+    relay_rate, _, relay_burst = relay_rate.partition(':')
+    MAIL_RATE_LIMITS[relay_host.strip()] = (float(relay_rate), int(relay_burst or MAIL_RATE_BURST))
+# Mail tasks that were throttled or got a 4xx reply are retried this many times, backing off up to MAIL_MAX_BACKOFF seconds
+MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 100)
+MAIL_MAX_BACKOFF = int(os.environ.get('MAIL_MAX_BACKOFF') or 300)
 
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL') or 'test@test.com'
 
 CSRF_COOKIE_SECURE = True
-SESSION_COOKIE_SECURE = True
-CONN_MAX_AGE = 600
\ No newline at end of file
+SESSION_COOKIE_SECURE = True
\ No newline at end of file
@@ -20,6 +20,7 @@ from rest_framework import routers
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 from checkout_api.views import ProductListView, PlaceOrderView, StripeWebhookView, ClientHomeView, ClientPaymentView
 from mail_dispatch_api.views import DispatchAPIView
+from commerceproject.views import MetricsView
 
 urlpatterns = [
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
@@ -32,4 +33,5 @@ urlpatterns = [
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
     path('admin/', admin.site.urls),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
@@ -0,0 +1,8 @@
+from django.http import HttpResponse
+from django.views import View
+from commerceproject.metrics_store import metrics_store
+
+class MetricsView(View):
+    # Prometheus text format, of every web and worker process
+    def get(self, request):
+        return HttpResponse(metrics_store.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,149 @@
+import os
+import time
+import asyncio
+import smtplib
+import threading
+import contextlib
+import aiosmtplib
+from django.conf import settings
+from mail_dispatch_api.throttle import MailPartiallySent
+
+class AsyncMailSender:
+    # runs many SMTP sessions at once from one process, on an event loop in a background thread,
+    # so a chunk of messages costs roughly the slowest send instead of the sum of all of them
+    def __init__(self, **connection_kwargs):
+        self.connection_kwargs = connection_kwargs
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # a forked child gets its own loop, the parent's thread doesn't exist there
+        self.loop = None
+        self.idle = None
+        self.sessions = None
+        # domain: [semaphore, sends using it], only domains with sends in flight
+        self.domains = {}
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='async-mail-sender', daemon=True).start()
+
+            return self.loop
+
+    def send_messages(self, messages):
+        # same contract as the SMTP connection manager, blocks until every message was tried
+        if not messages:
+            return 0
+
+        return asyncio.run_coroutine_threadsafe(self.send_all(messages), self.get_loop()).result()
+
+    def close(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.close_idle(), self.loop).result()
+
+    async def send_all(self, messages):
+        if self.sessions is None:
+            # created on the loop they're used on
+            self.idle = []
+            self.sessions = asyncio.Semaphore(settings.MAIL_ASYNC_CONCURRENCY)
+
+        results = await asyncio.gather(*[self.send(message) for message in messages], return_exceptions=True)
+        failed = [index for index, result in enumerate(results) if isinstance(result, BaseException)]
+
+        if not failed:
+            return len(results)
+
+        if len(failed) == len(results):
+            raise results[0]
+
+        raise MailPartiallySent(len(results) - len(failed), failed, results[failed[0]])
+
+    @contextlib.asynccontextmanager
+    async def domain_limit(self, message):
+        domain = message.recipients()[0].rpartition('@')[2].lower()
+
+        if domain not in self.domains:
+            self.domains[domain] = [asyncio.Semaphore(settings.MAIL_ASYNC_PER_DOMAIN), 0]
+
+        limit = self.domains[domain]
+        limit[1] += 1
+
+        try:
+            async with limit[0]:
+                yield
+        finally:
+            # the last send to a domain drops its semaphore, a campaign to many domains doesn't keep them all
+            limit[1] -= 1
+
+            if not limit[1]:
+                del self.domains[domain]
+
+    async def send(self, message):
+        async with self.domain_limit(message), self.sessions:
+            for attempt in range(2):
+                client = await self.acquire()
+
+                try:
+                    await client.send_message(message.message(), sender=message.from_email, recipients=message.recipients())
+                except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+                    # idle sessions get closed on the server side, one fresh session gets a retry
+                    await self.discard(client)
+
+                    if attempt:
+                        raise
+
+                    continue
+                except aiosmtplib.SMTPResponseException as e:
+                    await self.discard(client)
+                    # the retry logic of the tasks works with smtplib's exceptions
+                    raise smtplib.SMTPResponseException(e.code, e.message) from e
+                except (aiosmtplib.SMTPException, OSError):
+                    await self.discard(client)
+                    raise
+
+                client.sent += 1
+                self.idle.append(client)
+
+                return
+
+    async def acquire(self):
+        while self.idle:
+            client = self.idle.pop()
+
+            if client.is_connected and client.sent < settings.EMAIL_CONNECTION_MAX_MESSAGES and time.monotonic() - client.opened_at < settings.EMAIL_CONNECTION_MAX_AGE:
+                return client
+
+            await self.discard(client)
+
+        client = aiosmtplib.SMTP(**self.client_kwargs())
+        await client.connect()
+        client.opened_at = time.monotonic()
+        client.sent = 0
+
+        return client
+
+    async def discard(self, client):
+        try:
+            await client.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            client.close()
+
+    async def close_idle(self):
+        while self.idle:
+            await self.discard(self.idle.pop())
+
+    def client_kwargs(self):
+        return {
+            'hostname': self.connection_kwargs.get('host', settings.EMAIL_HOST),
+            'port': self.connection_kwargs.get('port', settings.EMAIL_PORT),
+            'username': self.connection_kwargs.get('username', settings.EMAIL_HOST_USER) or None,
+            'password': self.connection_kwargs.get('password', settings.EMAIL_HOST_PASSWORD) or None,
+            'use_tls': self.connection_kwargs.get('use_ssl', settings.EMAIL_USE_SSL),
+            'start_tls': self.connection_kwargs.get('use_tls', settings.EMAIL_USE_TLS),
+            'timeout': self.connection_kwargs.get('timeout', settings.EMAIL_TIMEOUT),
+        }
+
+async_sender = AsyncMailSender()
+os.register_at_fork(after_in_child=async_sender.reset)
@@ -0,0 +1,86 @@
+import json
+import hashlib
+import logging
+import redis
+from redis.retry import Retry
+from redis.backoff import NoBackoff
+from django.conf import settings
+from django.db import connection
+from commerceproject.redis_client import InstrumentedRedis, rd_instance
+
+logger = logging.getLogger(__name__)
+
+BODY_FIELDS = ('msg_content', 'html_content')
+
+# stashing happens on the request thread, so it gets a pool of its own that gives up on a stalled
+# Redis after TASK_PUBLISH_TIMEOUT, in one attempt, like publishing the task itself
+stash_client = InstrumentedRedis.from_url(
+    settings.CELERY_BROKER_URL,
+    socket_timeout=settings.TASK_PUBLISH_TIMEOUT,
+    socket_connect_timeout=settings.TASK_PUBLISH_TIMEOUT,
+    retry=Retry(NoBackoff(), 0),
+)
+
+class MailBodyExpired(Exception):
+    def __init__(self, key):
+        super().__init__(f'Mail body {key} is no longer in Redis')
+        self.key = key
+
+def body_key(digest):
+    return f"mail-body:{connection.settings_dict['NAME']}:{digest}"
+
+def stash_bodies(emails):
+    # large bodies stay in Redis and the task carries their key, keyed by content so a
+    # campaign sending the same body to every recipient stores it once
+    blobs = {}
+    stashed = []
+
+    for email_data in emails:
+        body = json.dumps({field: email_data[field] for field in BODY_FIELDS if email_data.get(field)}, sort_keys=True).encode()
+
+        if len(body) < settings.MAIL_BODY_REF_MIN_SIZE:
+            stashed.append(email_data)
+            continue
+
+        key = body_key(hashlib.sha256(body).hexdigest())
+        blobs[key] = body
+        stashed.append(dict({field: value for field, value in email_data.items() if field not in BODY_FIELDS}, body_ref=key))
+
+    if not blobs:
+        return stashed
+
+    try:
+        pipe = stash_client.pipeline(transaction=False)
+
+        for key, body in blobs.items():
+            # every stash pushes the expiry back, the copy outlives the retries of any task using it
+            pipe.set(key, body, ex=settings.MAIL_BODY_TTL)
+
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        logger.warning('Mail bodies could not be stored in Redis, sending them inline.')
+        return list(emails)
+
+    return stashed
+
+def load_bodies(emails):
+    keys = list({email_data['body_ref'] for email_data in emails if 'body_ref' in email_data})
+
+    if not keys:
+        return emails
+
+    bodies = dict(zip(keys, rd_instance.mget(keys)))
+    loaded = []
+
+    for email_data in emails:
+        if 'body_ref' in email_data:
+            key = email_data['body_ref']
+
+            if bodies[key] is None:
+                raise MailBodyExpired(key)
+
+            email_data = dict({field: value for field, value in email_data.items() if field != 'body_ref'}, **json.loads(bodies[key]))
+
+        loaded.append(email_data)
+
+    return loaded
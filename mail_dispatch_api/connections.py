@@ -0,0 +1,91 @@
+import os
+import time
+import smtplib
+import logging
+import threading
+from django.conf import settings
+from django.core.mail import get_connection
+from mail_dispatch_api.throttle import MailPartiallySent
+
+logger = logging.getLogger(__name__)
+
+class SMTPConnectionManager:
+    # keeps one mail connection open per worker process, so the TLS handshake and AUTH
+    # are paid once per EMAIL_CONNECTION_MAX_MESSAGES messages instead of once per message
+    def __init__(self, **connection_kwargs):
+        self.connection_kwargs = connection_kwargs
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # a forked child must not write to its parent's socket, so it just forgets the connection
+        self.connection = None
+        self.opened_at = 0
+        self.sent = 0
+
+    def is_expired(self):
+        return self.sent >= settings.EMAIL_CONNECTION_MAX_MESSAGES or time.monotonic() - self.opened_at >= settings.EMAIL_CONNECTION_MAX_AGE
+
+    def open(self):
+        connection = get_connection(fail_silently=False, **self.connection_kwargs)
+        connection.open()
+
+        self.connection = connection
+        self.opened_at = time.monotonic()
+        self.sent = 0
+
+    def close(self):
+        if self.connection is None:
+            return
+
+        try:
+            self.connection.close()
+        except (smtplib.SMTPException, OSError):
+            # the server may have dropped it already
+            pass
+
+        self.connection = None
+
+    def send_messages(self, messages):
+        # one message at a time over the same session, so a lost connection only resends the
+        # message it was lost on and never the ones the server already accepted
+        with self.lock:
+            count = 0
+
+            for index, message in enumerate(messages):
+                try:
+                    count += self.send_message(message)
+                except Exception as e:
+                    if not index:
+                        raise
+
+                    raise MailPartiallySent(count, list(range(index, len(messages))), e) from e
+
+            return count
+
+    def send_message(self, message):
+        if self.connection is not None and self.is_expired():
+            self.close()
+
+        if self.connection is None:
+            self.open()
+
+        try:
+            count = self.connection.send_messages([message])
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # idle connections get closed on the server side, one fresh connection gets a retry
+            logger.info('Mail connection was lost, reconnecting.')
+            self.close()
+            self.open()
+            count = self.connection.send_messages([message])
+        except smtplib.SMTPException:
+            # the session may be mid-transaction, start the next send on a clean one
+            self.close()
+            raise
+
+        self.sent += 1
+
+        return count
+
+smtp_connections = SMTPConnectionManager()
+os.register_at_fork(after_in_child=smtp_connections.reset)
@@ -0,0 +1,111 @@
+import time
+import threading
+import socketserver
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from mail_dispatch_api.connections import SMTPConnectionManager
+from mail_dispatch_api.async_sender import AsyncMailSender
+from mail_dispatch_api.services import build_message
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    # just enough SMTP for Django's backend, every message is accepted and thrown away
+    def handle(self):
+        self.server.count_connection()
+        # stands in for the TCP, TLS and AUTH round trips of a real relay
+        time.sleep(self.server.connect_latency)
+        self.wfile.write(b'220 localhost ESMTP sink\r\n')
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                break
+
+            command = line[:4].upper()
+            # a relay is a network round trip away from the worker
+            time.sleep(self.server.reply_latency)
+
+            if command == b'DATA':
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+
+                self.server.count_message()
+                self.wfile.write(b'250 OK\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                break
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, connect_latency, reply_latency):
+        super().__init__(('127.0.0.1', 0), SinkHandler)
+        self.connect_latency = connect_latency
+        self.reply_latency = reply_latency
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = 0
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def count_message(self):
+        with self.lock:
+            self.received += 1
+
+class Command(BaseCommand):
+    help = "Compares sending mail over one connection per message with the pooled worker connection, against a local SMTP sink"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500)
+        parser.add_argument('--connect-latency', type=float, default=50, help='Milliseconds the sink waits before greeting a new connection')
+        parser.add_argument('--reply-latency', type=float, default=2, help='Milliseconds the sink waits before answering each command')
+        parser.add_argument('--chunk-size', type=int, default=100, help='Messages handed to the async sender at once')
+
+    def handle(self, *args, **options):
+        server = SinkServer(options['connect_latency'] / 1000, options['reply_latency'] / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        connection_kwargs = {
+            'backend': 'django.core.mail.backends.smtp.EmailBackend',
+            'host': server.server_address[0],
+            'port': server.server_address[1],
+            'username': '',
+            'password': '',
+            'use_tls': False,
+            'use_ssl': False,
+        }
+        message = build_message({'recipient': 'test@test.com', 'subject': 'Benchmark', 'msg_content': 'Order Receipt'})
+        manager = SMTPConnectionManager(**connection_kwargs)
+        sender = AsyncMailSender(**connection_kwargs)
+        chunk = [message] * options['chunk_size']
+
+        try:
+            # what send_mail() does, a connection is opened and closed around every message
+            per_message = self.measure(lambda: get_connection(fail_silently=False, **connection_kwargs).send_messages([message]), options['messages'])
+            pooled = self.measure(lambda: manager.send_messages([message]), options['messages'])
+            concurrent = self.measure(lambda: sender.send_messages(chunk), options['messages'] // len(chunk), len(chunk))
+        finally:
+            manager.close()
+            sender.close()
+            server.shutdown()
+            server.server_close()
+
+        self.stdout.write('Connection per message: %.1f messages/s' % per_message)
+        self.stdout.write('Pooled connection: %.1f messages/s' % pooled)
+        self.stdout.write('Async sender: %.1f messages/s' % concurrent)
+        self.stdout.write(
+            self.style.SUCCESS('Successfully sent "%s" messages, %.1fx faster pooled, %.1fx faster async' % (server.received, pooled / per_message, concurrent / per_message)))
+
+    def measure(self, send, count, per_call=1):
+        started = time.perf_counter()
+
+        for _ in range(count):
+            send()
+
+        return count * per_call / (time.perf_counter() - started)
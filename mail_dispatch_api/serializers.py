@@ -3,4 +3,5 @@ from rest_framework import serializers
 class EmailDataSerializer(serializers.Serializer):
     recipient = serializers.EmailField()
     subject = serializers.CharField(max_length=200)
-    msg_content = serializers.CharField()
\ No newline at end of file
+    msg_content = serializers.CharField()
+    html_content = serializers.CharField(required=False)
\ No newline at end of file
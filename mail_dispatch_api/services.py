@@ -1,15 +1,51 @@
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
+from mail_dispatch_api.connections import smtp_connections
+from mail_dispatch_api.async_sender import async_sender
+from mail_dispatch_api.throttle import take_tokens, mail_sent, MailPartiallySent
+from mail_dispatch_api.blobs import load_bodies
+
+def build_message(email_data):
+    message = EmailMultiAlternatives(
+        email_data['subject'],
+        email_data['msg_content'],
+        settings.DEFAULT_FROM_EMAIL,
+        [email_data['recipient']],
+    )
+
+    if email_data.get('html_content'):
+        message.attach_alternative(email_data['html_content'], 'text/html')
+
+    return message
+
+def send_messages(messages):
+    # raises MailThrottled before anything is sent when the relay budget is used up
+    take_tokens(len(messages))
+
+    sender = async_sender if settings.MAIL_SENDER == 'async' else smtp_connections
+
+    try:
+        count = sender.send_messages(messages)
+    except MailPartiallySent as e:
+        mail_sent.inc(e.sent, host=settings.EMAIL_HOST)
+        raise
+
+    mail_sent.inc(count, host=settings.EMAIL_HOST)
+
+    return count
+
+def send_chunk(items, messages):
+    # one message per item, a partly sent chunk is reported with the items whose messages
+    # didn't go out, so the task retries only those
+    try:
+        return send_messages(messages)
+    except MailPartiallySent as e:
+        raise MailPartiallySent(e.sent, [items[index] for index in e.failed], e.error) from e
 
 def sendmail_service(email_data):
-    recipient = email_data['recipient']
-    subject = email_data['subject']
-    msg_content = email_data['msg_content']
+    # goes through the worker's long-lived connection instead of send_mail()'s one per message
+    return send_messages([build_message(email_data) for email_data in load_bodies([email_data])])
 
-    return send_mail(
-        subject,
-        msg_content,
-        settings.DEFAULT_FROM_EMAIL,
-        [recipient],
-        fail_silently=False,
-    )
\ No newline at end of file
+def sendmail_batch_service(emails):
+    # the whole chunk goes through one SMTP session
+    return send_chunk(emails, [build_message(email_data) for email_data in load_bodies(emails)])
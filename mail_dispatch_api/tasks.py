@@ -1,7 +1,40 @@
 from celery import shared_task
-from mail_dispatch_api.services import sendmail_service
+from django.conf import settings
+from mail_dispatch_api.services import sendmail_service, sendmail_batch_service
+from mail_dispatch_api.throttle import MailThrottled, MailPartiallySent, retry_countdown
+from mail_dispatch_api.blobs import stash_bodies
+from commerceproject.producer import publish
+from commerceproject.celery import FIRE_AND_FORGET, BULK_PAYLOAD
+import smtplib
 
-@shared_task
-def sendmail_task(data):
-    return sendmail_service(data)
+def send_or_defer(task, send, *args):
+    # over budget or pushed back by the relay, the task waits its turn instead of failing
+    try:
+        return send(*args)
+    except (MailThrottled, MailPartiallySent, smtplib.SMTPResponseException) as e:
+        countdown = retry_countdown(e, task.request.retries)
 
+        if countdown is None:
+            raise
+
+        if isinstance(e, MailPartiallySent):
+            # chunk tasks take their list of items first, the retry gets the unsent ones
+            raise task.retry(args=[e.failed, *args[1:]], exc=e.error, countdown=countdown)
+
+        raise task.retry(exc=e, countdown=countdown)
+
+@shared_task(bind=True, max_retries=settings.MAIL_MAX_RETRIES, **FIRE_AND_FORGET)
+def sendmail_task(self, data):
+    return send_or_defer(self, sendmail_service, data)
+
+@shared_task(bind=True, max_retries=settings.MAIL_MAX_RETRIES, **BULK_PAYLOAD)
+def sendmail_batch_task(self, data):
+    return send_or_defer(self, sendmail_batch_service, data)
+
+def enqueue_mail_batch(emails):
+    # one broker message per chunk instead of one per email
+    size = settings.MAIL_CHUNK_SIZE
+    emails = stash_bodies(emails)
+
+    for index in range(0, len(emails), size):
+        publish(sendmail_batch_task, emails[index:index + size])
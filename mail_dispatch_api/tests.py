@@ -1,8 +1,28 @@
 from django.test import TestCase, Client, override_settings
 from mail_dispatch_api.serializers import EmailDataSerializer
-from mail_dispatch_api.services import sendmail_service
-from unittest.mock import patch
+from mail_dispatch_api.services import sendmail_service, sendmail_batch_service, build_message
+from mail_dispatch_api.tasks import enqueue_mail_batch, sendmail_task, sendmail_batch_task
+from mail_dispatch_api.connections import SMTPConnectionManager, smtp_connections
+from mail_dispatch_api.async_sender import AsyncMailSender
+from mail_dispatch_api.management.commands.benchmark_mail import SinkServer
+import threading
+import socket
+import time
+import json
+from unittest.mock import patch, MagicMock
+from django.core import mail
+from django.core.management import call_command
+from io import StringIO
+import smtplib
+import aiosmtplib
+from celery.exceptions import Retry
+from commerceproject.redis_client import rd_instance
+from mail_dispatch_api.throttle import take_tokens, bucket_key, retry_countdown, MailThrottled, MailPartiallySent, mail_sent, mail_throttled
 from django.conf import settings
+from commerceproject.celery import app
+from commerceproject.producer import TaskProducer, tasks_buffered, tasks_dropped, buffer_size
+from mail_dispatch_api.blobs import stash_bodies, load_bodies, MailBodyExpired, stash_client
+import redis
 
 class EmailSerializerTestCase(TestCase):
     def test_instance_validation(self):
@@ -58,10 +78,13 @@ class EmailSerializerTestCase(TestCase):
 class DispatchAPITestCase(TestCase):
     def setUp(self):
         self.client = Client()
-    @patch("mail_dispatch_api.views.sendmail_task")
-    def test_post(self, mock_task):
-        response = self.client.post('/')
+    @patch("mail_dispatch_api.views.publish")
+    def test_post(self, mock_publish):
+        url = '/api/mail/'
+
+        response = self.client.post(url)
         self.assertEqual(response.status_code, 400)
+        mock_publish.assert_not_called()
 
         data = {
             "recipient": "test@test.com",
@@ -69,22 +92,412 @@ class DispatchAPITestCase(TestCase):
             "msg_content": "Gimme fuel gimme fire"
         }
 
-        response = self.client.post('/', data=data)
+        response = self.client.post(url, data=data)
         self.assertEqual(response.status_code, 200)
-        mock_task.delay.assert_called_once()
-        mock_task.delay.assert_called_with(data)
+        mock_publish.assert_called_once_with(sendmail_task, data)
         self.assertEqual(response.json()['msg'], "Success! We've accepted your email request and are dispatching the message now.")
 
+class DispatchBatchAPITestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.data = [{"recipient": f"test{index}@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"} for index in range(5)]
+
+    @override_settings(MAIL_BATCH_MAX_SIZE=5)
+    @patch("mail_dispatch_api.views.enqueue_mail_batch")
+    def test_post(self, mock_enqueue):
+        url = '/api/mail/'
+
+        response = self.client.post(url, data=[], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        invalid = self.data[:2] + [{"recipient": "email", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}]
+        response = self.client.post(url, data=invalid, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(str(response.json()[2]['recipient'][0]), "Enter a valid email address.")
+
+        response = self.client.post(url, data=self.data + self.data[:1], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        mock_enqueue.assert_not_called()
+
+        response = self.client.post(url, data=self.data, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 5)
+        mock_enqueue.assert_called_once_with(self.data)
+
+    @override_settings(MAIL_CHUNK_SIZE=2)
+    @patch("mail_dispatch_api.tasks.publish")
+    def test_enqueue_mail_batch(self, mock_publish):
+        enqueue_mail_batch(self.data)
+
+        self.assertEqual([call.args for call in mock_publish.call_args_list], [(sendmail_batch_task, self.data[:2]), (sendmail_batch_task, self.data[2:4]), (sendmail_batch_task, self.data[4:])])
+
 class ServiceTestCase(TestCase):
-    @patch("mail_dispatch_api.services.send_mail")
-    def test_sendmail_service(self, mock_send_mail):
+    def tearDown(self):
+        smtp_connections.close()
+
+    def test_sendmail_service(self):
         data = {
             "recipient": "test@test.com",
             "subject": "Bro",
             "msg_content": "Gimme fuel gimme fire"
         }
 
+        self.assertEqual(sendmail_service(data), 1)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, data['subject'])
+        self.assertEqual(mail.outbox[0].body, data['msg_content'])
+        self.assertEqual(mail.outbox[0].from_email, settings.DEFAULT_FROM_EMAIL)
+        self.assertEqual(mail.outbox[0].to, [data['recipient']])
+        self.assertEqual(mail.outbox[0].alternatives, [])
+
+        # HTML goes out as an alternative to the text
+        data['html_content'] = '<p>Gimme fuel gimme fire</p>'
         sendmail_service(data)
 
-        mock_send_mail.assert_called_once()
-        mock_send_mail.assert_called_with(data['subject'], data['msg_content'], settings.DEFAULT_FROM_EMAIL, [data['recipient']], fail_silently=False)
+        self.assertEqual(mail.outbox[1].alternatives[0].content, data['html_content'])
+        self.assertEqual(mail.outbox[1].alternatives[0].mimetype, 'text/html')
+
+    @patch("mail_dispatch_api.connections.get_connection")
+    def test_sendmail_batch_service(self, mock_get_connection):
+        emails = [{"recipient": f"test{index}@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"} for index in range(3)]
+        mock_get_connection.return_value.send_messages.return_value = 1
+
+        self.assertEqual(sendmail_batch_service(emails), 3)
+
+        # one session for the whole chunk
+        mock_get_connection.assert_called_once()
+        messages = [call.args[0][0] for call in mock_get_connection.return_value.send_messages.call_args_list]
+        self.assertEqual([message.to for message in messages], [[email['recipient']] for email in emails])
+
+class SMTPConnectionManagerTestCase(TestCase):
+    def setUp(self):
+        self.manager = SMTPConnectionManager()
+        self.message = build_message({"recipient": "test@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"})
+
+    @patch("mail_dispatch_api.connections.get_connection")
+    def test_reuse(self, mock_get_connection):
+        for _ in range(3):
+            self.manager.send_messages([self.message])
+
+        mock_get_connection.assert_called_once()
+        self.assertEqual(mock_get_connection.return_value.send_messages.call_count, 3)
+
+    @override_settings(EMAIL_CONNECTION_MAX_MESSAGES=2)
+    @patch("mail_dispatch_api.connections.get_connection")
+    def test_recycle(self, mock_get_connection):
+        for _ in range(5):
+            self.manager.send_messages([self.message])
+
+        self.assertEqual(mock_get_connection.call_count, 3)
+        self.assertEqual(mock_get_connection.return_value.close.call_count, 2)
+
+        with override_settings(EMAIL_CONNECTION_MAX_AGE=0):
+            self.manager.send_messages([self.message])
+
+        self.assertEqual(mock_get_connection.call_count, 4)
+
+    @patch("mail_dispatch_api.connections.get_connection")
+    def test_reconnect(self, mock_get_connection):
+        lost = MagicMock()
+        lost.send_messages.side_effect = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        mock_get_connection.side_effect = [lost, MagicMock(), MagicMock()]
+
+        self.manager.send_messages([self.message])
+
+        self.assertEqual(mock_get_connection.call_count, 2)
+        self.assertIsNot(self.manager.connection, lost)
+        self.manager.connection.send_messages.assert_called_once_with([self.message])
+
+        # other failures surface, and the next message gets a fresh connection
+        self.manager.connection.send_messages.side_effect = smtplib.SMTPDataError(554, 'Rejected')
+
+        with self.assertRaises(smtplib.SMTPDataError):
+            self.manager.send_messages([self.message])
+
+        self.assertIsNone(self.manager.connection)
+
+    @patch("mail_dispatch_api.connections.get_connection")
+    def test_reconnect_midway(self, mock_get_connection):
+        messages = [build_message({"recipient": f"test{index}@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}) for index in range(3)]
+        lost = MagicMock()
+        lost.send_messages.side_effect = [1, smtplib.SMTPServerDisconnected('Connection unexpectedly closed')]
+        fresh = MagicMock()
+        fresh.send_messages.return_value = 1
+        mock_get_connection.side_effect = [lost, fresh]
+
+        self.assertEqual(self.manager.send_messages(messages), 3)
+
+        # the message accepted before the connection dropped isn't sent again
+        self.assertEqual([call.args[0] for call in lost.send_messages.call_args_list], [[messages[0]], [messages[1]]])
+        self.assertEqual([call.args[0] for call in fresh.send_messages.call_args_list], [[messages[1]], [messages[2]]])
+
+        # a refusal midway leaves the rest of the chunk for the retry
+        fresh.send_messages.side_effect = [1, smtplib.SMTPDataError(451, 'Try again later')]
+
+        with self.assertRaises(MailPartiallySent) as e:
+            self.manager.send_messages(messages)
+
+        self.assertEqual((e.exception.sent, e.exception.failed), (1, [1, 2]))
+
+class AsyncMailSenderTestCase(TestCase):
+    def setUp(self):
+        self.server = SinkServer(0, 0.005)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.sender = AsyncMailSender(host=self.server.server_address[0], port=self.server.server_address[1], username='', password='', use_tls=False, use_ssl=False)
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @override_settings(MAIL_ASYNC_CONCURRENCY=4, MAIL_ASYNC_PER_DOMAIN=2)
+    def test_send_messages(self):
+        messages = [build_message({"recipient": f"test{index}@test{index % 2}.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}) for index in range(20)]
+
+        self.assertEqual(self.sender.send_messages(messages), 20)
+        self.assertEqual(self.server.received, 20)
+        # sessions are bounded and reused
+        self.assertLessEqual(self.server.connections, 4)
+
+        self.assertEqual(self.sender.send_messages(messages[:4]), 4)
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_send_messages_partly(self):
+        messages = [build_message({"recipient": f"test{index}@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}) for index in range(3)]
+        send_message = aiosmtplib.SMTP.send_message
+
+        async def refuse_test1(client, message, sender=None, recipients=None):
+            if recipients == ['test1@test.com']:
+                raise aiosmtplib.SMTPResponseException(451, 'Try again later')
+
+            return await send_message(client, message, sender=sender, recipients=recipients)
+
+        with patch.object(aiosmtplib.SMTP, 'send_message', refuse_test1):
+            with self.assertRaises(MailPartiallySent) as e:
+                self.sender.send_messages(messages)
+
+        # only the refused message is left for the retry
+        self.assertEqual(e.exception.sent, 2)
+        self.assertEqual(e.exception.failed, [1])
+        self.assertEqual(e.exception.error.smtp_code, 451)
+        self.assertEqual(self.server.received, 2)
+        # no semaphores are kept for domains nothing is being sent to
+        self.assertEqual(self.sender.domains, {})
+
+    def test_sendmail_service(self):
+        with override_settings(MAIL_SENDER='async'), patch('mail_dispatch_api.services.async_sender', self.sender):
+            self.assertEqual(sendmail_service({"recipient": "test@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}), 1)
+
+        self.assertEqual(self.server.received, 1)
+        # the Django backend was bypassed
+        self.assertEqual(len(mail.outbox), 0)
+
+class BenchmarkMailCommandTestCase(TestCase):
+    def test_output(self):
+        out = StringIO()
+        call_command('benchmark_mail', messages=10, connect_latency=0, reply_latency=0, chunk_size=5, stdout=out)
+
+        self.assertIn('Successfully sent "30" messages', out.getvalue())
+
+class MailThrottleTestCase(TestCase):
+    def setUp(self):
+        rd_instance.delete(bucket_key('relay.test'), bucket_key(settings.EMAIL_HOST))
+        mail_sent.reset()
+        mail_throttled.reset()
+
+    def tearDown(self):
+        rd_instance.delete(bucket_key('relay.test'), bucket_key(settings.EMAIL_HOST))
+        smtp_connections.close()
+
+    @override_settings(MAIL_RATE_LIMITS={'relay.test': (10, 3)})
+    def test_take_tokens(self):
+        # the burst goes through right away
+        for _ in range(3):
+            take_tokens(1, 'relay.test')
+
+        with self.assertRaises(MailThrottled) as e:
+            take_tokens(1, 'relay.test')
+
+        self.assertGreater(e.exception.countdown, 0)
+        self.assertLessEqual(e.exception.countdown, 0.1)
+        self.assertEqual(mail_throttled.get(host='relay.test'), 1)
+
+        # a chunk bigger than the bucket waits for a full one, not forever
+        with self.assertRaises(MailThrottled) as e:
+            take_tokens(50, 'relay.test')
+
+        self.assertLessEqual(e.exception.countdown, 0.3)
+
+        # unlimited hosts never touch Redis
+        with override_settings(MAIL_RATE_LIMIT=0):
+            take_tokens(1000, 'other.test')
+
+    @override_settings(MAIL_RATE_LIMIT=1, MAIL_RATE_BURST=1)
+    def test_sendmail_task(self):
+        data = {"recipient": "test@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}
+
+        self.assertEqual(sendmail_task.apply(args=[data]).get(), 1)
+        self.assertEqual(mail_sent.get(host=settings.EMAIL_HOST), 1)
+
+        # over budget, the task is deferred instead of failing
+        with patch.object(sendmail_task, 'retry', side_effect=Retry()) as mock_retry:
+            sendmail_task.apply(args=[data])
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertGreater(mock_retry.call_args.kwargs['countdown'], 0)
+        self.assertIsInstance(mock_retry.call_args.kwargs['exc'], MailThrottled)
+
+    def test_sendmail_batch_task_partly_sent(self):
+        emails = [{"recipient": f"test{index}@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"} for index in range(3)]
+        error = smtplib.SMTPDataError(451, 'Try again later')
+
+        with patch('mail_dispatch_api.services.smtp_connections.send_messages', side_effect=MailPartiallySent(1, [1, 2], error)), \
+                patch.object(sendmail_batch_task, 'retry', side_effect=Retry()) as mock_retry:
+            sendmail_batch_task.apply(args=[emails])
+
+        # the retry carries only what didn't go out
+        self.assertEqual(mock_retry.call_args.kwargs['args'], [emails[1:]])
+        self.assertIs(mock_retry.call_args.kwargs['exc'], error)
+        self.assertEqual(mail_sent.get(host=settings.EMAIL_HOST), 1)
+
+    def test_retry_countdown(self):
+        self.assertEqual(retry_countdown(smtplib.SMTPDataError(421, 'Too many messages'), 3), 8)
+        self.assertEqual(retry_countdown(smtplib.SMTPDataError(421, 'Too many messages'), 20), settings.MAIL_MAX_BACKOFF)
+        self.assertIsNone(retry_countdown(smtplib.SMTPDataError(554, 'Rejected'), 0))
+
+class CeleryRoutingTestCase(TestCase):
+    def route(self, name):
+        return app.amqp.router.route({}, name)
+
+    def test_routes(self):
+        # receipts never share a queue with bulk mail
+        self.assertEqual(self.route('checkout_api.tasks.sendreciept_task')['queue'].name, 'transactional')
+        self.assertEqual(self.route('checkout_api.tasks.sendreciept_task')['priority'], 0)
+        self.assertEqual(self.route('checkout_api.tasks.sendreciepts_task')['queue'].name, 'transactional')
+        self.assertEqual(self.route('mail_dispatch_api.tasks.sendmail_task')['queue'].name, 'bulk')
+        self.assertEqual(self.route('mail_dispatch_api.tasks.sendmail_batch_task')['queue'].name, 'bulk')
+        self.assertEqual(self.route('checkout_api.tasks.release_expired_holds_task')['queue'].name, 'celery')
+
+    def test_profiles(self):
+        from checkout_api.tasks import sendreciept_task
+
+        self.assertTrue(sendreciept_task.ignore_result)
+        self.assertTrue(sendmail_task.ignore_result)
+        self.assertIsNone(sendmail_task._get_exec_options()['compression'])
+        self.assertTrue(sendmail_batch_task.ignore_result)
+        self.assertEqual(sendmail_batch_task._get_exec_options()['compression'], 'zlib')
+
+class MailBodyBlobTestCase(TestCase):
+    def setUp(self):
+        self.body = "Gimme fuel gimme fire " * 100
+        self.emails = [
+            {"recipient": "test0@test.com", "subject": "Bro", "msg_content": self.body, "html_content": f"<p>{self.body}</p>"},
+            {"recipient": "test1@test.com", "subject": "Bro", "msg_content": self.body, "html_content": f"<p>{self.body}</p>"},
+            {"recipient": "test2@test.com", "subject": "Bro", "msg_content": "Short one"},
+        ]
+
+    @override_settings(MAIL_BODY_REF_MIN_SIZE=1024)
+    def test_stash_bodies(self):
+        stashed = stash_bodies(self.emails)
+        self.addCleanup(rd_instance.delete, stashed[0]['body_ref'])
+
+        # the campaign body is stored once, short bodies stay in the task
+        self.assertEqual(stashed[0]['body_ref'], stashed[1]['body_ref'])
+        self.assertNotIn('msg_content', stashed[0])
+        self.assertEqual(stashed[2], self.emails[2])
+        self.assertLess(len(json.dumps(stashed)), len(self.body))
+
+        self.assertEqual(load_bodies(stashed), self.emails)
+
+        rd_instance.delete(stashed[0]['body_ref'])
+
+        with self.assertRaises(MailBodyExpired):
+            load_bodies(stashed)
+
+    @patch('mail_dispatch_api.blobs.stash_client.pipeline', side_effect=redis.exceptions.ConnectionError())
+    def test_stash_bodies_without_redis(self, mock_pipeline):
+        self.assertEqual(stash_bodies(self.emails), self.emails)
+
+    @override_settings(MAIL_BODY_REF_MIN_SIZE=1024)
+    def test_stash_bodies_slow_redis(self):
+        # a stalled Redis holds the request for TASK_PUBLISH_TIMEOUT at most, then the bodies go inline
+        self.assertEqual(stash_client.connection_pool.connection_kwargs['socket_timeout'], settings.TASK_PUBLISH_TIMEOUT)
+
+        with patch('redis.connection.Connection.read_response', side_effect=redis.exceptions.TimeoutError('Timeout reading from socket')) as mock_read_response:
+            self.assertEqual(stash_bodies(self.emails), self.emails)
+
+        # one attempt, no retries
+        self.assertEqual(mock_read_response.call_count, 1)
+
+    def test_sendmail_batch_task(self):
+        stashed = stash_bodies(self.emails)
+        self.addCleanup(rd_instance.delete, stashed[0]['body_ref'])
+
+        self.assertEqual(sendmail_batch_task.apply(args=[stashed]).get(), 3)
+        self.assertEqual(mail.outbox[0].body, self.body)
+        self.assertEqual(mail.outbox[1].alternatives[0][0], f"<p>{self.body}</p>")
+        smtp_connections.close()
+
+class TaskProducerTestCase(TestCase):
+    def setUp(self):
+        self.producer = TaskProducer()
+        self.data = {"recipient": "test@test.com", "subject": "Bro", "msg_content": "Gimme fuel gimme fire"}
+
+        for metric in (tasks_buffered, tasks_dropped, buffer_size):
+            metric.reset()
+
+    @override_settings(TASK_PUBLISH_TIMEOUT=0.2)
+    def test_slow_broker(self):
+        # a broker that takes connections and never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+        threading.Thread(target=lambda: [server.accept() for _ in range(5)], daemon=True).start()
+
+        url = 'redis://127.0.0.1:%s/0' % server.getsockname()[1]
+        connection_for_write = app.connection_for_write
+
+        with patch.object(app, 'connection_for_write', lambda **kwargs: connection_for_write(url, **kwargs)), patch.object(self.producer, 'run_flusher'):
+            started = time.perf_counter()
+            self.producer.publish(sendmail_task, self.data)
+            self.assertLess(time.perf_counter() - started, 2)
+
+            # the broker is known to be slow, the next one doesn't wait at all
+            started = time.perf_counter()
+            self.producer.publish(sendmail_task, self.data)
+            self.assertLess(time.perf_counter() - started, 0.1)
+
+        self.assertEqual(len(self.producer.buffer), 2)
+        self.assertEqual(tasks_buffered.get(task=sendmail_task.name), 2)
+        self.assertEqual(buffer_size.get(), 2)
+
+    @override_settings(TASK_PUBLISH_BUFFER_SIZE=2)
+    def test_buffer(self):
+        with patch.object(self.producer, 'send', return_value=False), patch.object(self.producer, 'run_flusher') as mock_run_flusher:
+            for _ in range(3):
+                self.producer.publish(sendmail_task, self.data)
+
+            self.assertEqual(self.producer.flush(), 0)
+
+        # one flusher thread for the process
+        mock_run_flusher.assert_called_once()
+        self.assertEqual(tasks_buffered.get(task=sendmail_task.name), 2)
+        self.assertEqual(tasks_dropped.get(task=sendmail_task.name), 1)
+
+        with patch.object(self.producer, 'send', return_value=True) as mock_send:
+            self.assertEqual(self.producer.flush(), 2)
+
+        mock_send.assert_called_with((sendmail_task, (self.data,), {}))
+        self.assertEqual(len(self.producer.buffer), 0)
+        self.assertEqual(buffer_size.get(), 0)
+
+    @patch.object(sendmail_task, 'apply_async')
+    def test_publish(self, mock_apply_async):
+        self.producer.publish(sendmail_task, self.data)
+
+        self.assertEqual(mock_apply_async.call_args.args, ((self.data,), {}))
+        self.assertFalse(mock_apply_async.call_args.kwargs['retry'])
+        self.assertEqual(len(self.producer.buffer), 0)
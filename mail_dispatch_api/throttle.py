@@ -0,0 +1,99 @@
+import time
+import logging
+import smtplib
+import redis
+from django.conf import settings
+from django.db import connection
+from commerceproject import metrics
+from commerceproject.redis_client import rd_instance
+
+logger = logging.getLogger(__name__)
+
+mail_sent = metrics.counter('mail_messages_sent_total', 'Emails handed to the SMTP relay.', ('host',))
+mail_throttled = metrics.counter('mail_messages_throttled_total', 'Emails deferred because the relay budget was used up.', ('host',))
+
+# A token bucket per relay host, shared by every mail worker. The hash holds the tokens left
+# and when they were counted; missing means full.
+# KEYS: bucket, ARGV: rate per second, capacity, now, tokens requested
+# returns the seconds to wait before asking again, 0 when the tokens were taken
+take_script = rd_instance.register_script("""
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+-- a chunk larger than the bucket goes once the bucket is full, and leaves it in debt
+local needed = math.min(requested, capacity)
+local wait = 0
+
+if tokens >= needed then
+    tokens = tokens - requested
+else
+    wait = (needed - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+
+return tostring(wait)
+""")
+
+class MailThrottled(Exception):
+    def __init__(self, host, countdown):
+        super().__init__(f'Mail relay {host} is over its budget, retry in {countdown:.2f}s')
+        self.host = host
+        self.countdown = countdown
+
+class MailPartiallySent(Exception):
+    # some messages of a chunk went out before the rest failed, retrying the whole chunk would send
+    # those twice. failed holds what wasn't sent, error the first reason why
+    def __init__(self, sent, failed, error):
+        super().__init__(f'{len(failed)} messages were not sent: {error!r}')
+        self.sent = sent
+        self.failed = failed
+        self.error = error
+
+def bucket_key(host):
+    return f"mail-bucket:{connection.settings_dict['NAME']}:{host}"
+
+def relay_limit(host):
+    # (sends per second, burst), a rate of 0 means unlimited
+    return settings.MAIL_RATE_LIMITS.get(host, (settings.MAIL_RATE_LIMIT, settings.MAIL_RATE_BURST))
+
+def take_tokens(count, host=None):
+    host = host or settings.EMAIL_HOST
+    rate, burst = relay_limit(host)
+
+    if rate <= 0:
+        return
+
+    try:
+        wait = float(take_script(keys=[bucket_key(host)], args=[rate, max(burst, 1), time.time(), count]))
+    except redis.exceptions.RedisError:
+        # the relay still has its own limits, so mail keeps flowing without Redis
+        logger.warning('Mail rate limiting is unavailable, sending unthrottled.')
+        return
+
+    if wait > 0:
+        mail_throttled.inc(count, host=host)
+        raise MailThrottled(host, wait)
+
+def retry_countdown(exc, retries):
+    # how long a mail task should wait before trying again, None when waiting won't help
+    if isinstance(exc, MailThrottled):
+        return exc.countdown
+
+    if isinstance(exc, MailPartiallySent):
+        return retry_countdown(exc.error, retries)
+
+    # 4xx replies are the relay pushing back, back off exponentially
+    if isinstance(exc, smtplib.SMTPResponseException) and 400 <= exc.smtp_code < 500:
+        return min(2 ** retries, settings.MAIL_MAX_BACKOFF)
+
+    return None
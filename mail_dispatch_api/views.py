@@ -1,17 +1,32 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from mail_dispatch_api.serializers import EmailDataSerializer
-from mail_dispatch_api.tasks import sendmail_task
+from mail_dispatch_api.tasks import sendmail_task, enqueue_mail_batch
+from mail_dispatch_api.blobs import stash_bodies
+from django.conf import settings
+from commerceproject.producer import publish
 from rest_framework import status, generics
 
 class DispatchAPIView(generics.CreateAPIView):
     serializer_class = EmailDataSerializer
 
     def create(self, request):
+        # a list body is a batch of emails
+        if isinstance(request.data, list):
+            return self.create_batch(request)
+
         serializer = EmailDataSerializer(data=request.data)
         if serializer.is_valid():
             serialized_data = serializer.validated_data
-            sendmail_task.delay(serialized_data)
+            publish(sendmail_task, stash_bodies([serialized_data])[0])
             return Response({'msg': "Success! We've accepted your email request and are dispatching the message now."}, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def create_batch(self, request):
+        serializer = EmailDataSerializer(data=request.data, many=True, allow_empty=False, max_length=settings.MAIL_BATCH_MAX_SIZE)
+        if serializer.is_valid():
+            enqueue_mail_batch([dict(email_data) for email_data in serializer.validated_data])
+            return Response({'msg': "Success! We've accepted your email requests and are dispatching the messages now.", 'count': len(serializer.validated_data)}, status=status.HTTP_200_OK)
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)